@@ -8,12 +8,15 @@
 
 # Query GitHub API
 import os
+import re
+import threading
 
 import pandas as pd
 
+from collections import OrderedDict
 from functools import partial
 
-from GH_CoRE.utils.cache import QueryCache
+from GH_CoRE.utils.cache import QueryCache, PersistentCacheStore
 from GH_CoRE.utils.conndb import ConnDB
 from GH_CoRE.utils.prepare_sql import get_params_condition, format_sql
 from GH_CoRE.utils.request_api import RequestGitHubAPI, GitHubGraphQLAPI
@@ -60,22 +63,12 @@ df_Actor, df_Repo = prepare_loc_actor_repo_table()
 
 
 # 2. query entity attributes from DataBase
-cache_db = QueryCache(max_size=200)
+cache_db = QueryCache(max_size=200, name='db')
 
 
-def _get_field_from_db(field, where_param, ret='any', dataframe_format=False, **kwargs):
-    cache_db.match_func = partial(QueryCache.d_match_func, **{
-        "feat_keys": ["field", "where_param", "ret", "dataframe_format", "kwargs"]})
-    feature_new_rec = {"field": field, "where_param": where_param, "ret": ret, "dataframe_format": dataframe_format,
-                       "kwargs": kwargs}
-    record_info_cached = cache_db.find_record_in_cache(feature_new_rec)
-    if record_info_cached:
-        result = dict(record_info_cached).get("result", None)
-        return result
-
-    if "platform" not in where_param.keys():
-        where_param = dict({"platform": 'GitHub'}, **where_param)
-    where_param_trimed = {k: v for k, v in where_param.items() if v is not None}
+def __query_field_from_db(field, where_param, ret='any', dataframe_format=False, **kwargs):
+    # return: (result, query_failed)
+    where_param_trimed = _trim_where_param(where_param)
     params_condition = get_params_condition(where_param_trimed)
     sql_params = dict(kwargs) if kwargs else {}
     sql_params["columns"] = field
@@ -87,13 +80,15 @@ def _get_field_from_db(field, where_param, ret='any', dataframe_format=False, **
 
     conndb = ConnDB()
     conndb.sql = sql
+    query_failed = False
     try:
         conndb.execute()
     except BaseException as e:
+        query_failed = True
         print(f"An unexpected error occurred: {e.__class__.__name__}! The query sql: {sql}.")
     df_rs = pd.DataFrame() if conndb.rs is None else conndb.rs
     if not len(df_rs):
-        return None if not dataframe_format else pd.DataFrame()
+        return (None if not dataframe_format else pd.DataFrame()), query_failed
 
     if ret in ['first', 'any']:
         result = df_rs.iloc[0]
@@ -107,11 +102,238 @@ def _get_field_from_db(field, where_param, ret='any', dataframe_format=False, **
         result = result[df_rs.columns[0]]
         if ret != 'all' and type(result) == list:
             result = result[0]
-    new_record = dict(**feature_new_rec, **{"result": result})
-    cache_db.add_record(new_record)
+    return result, query_failed
+
+
+def _get_db_feature(field, where_param, ret='any', dataframe_format=False, **kwargs):
+    return {"field": field, "where_param": where_param, "ret": ret, "dataframe_format": dataframe_format,
+            "kwargs": kwargs}
+
+
+def _set_cache_db_match_func():
+    cache_db.match_func = partial(QueryCache.d_match_func, **{
+        "feat_keys": ["field", "where_param", "ret", "dataframe_format", "kwargs"]})
+
+
+def _get_field_from_db(field, where_param, ret='any', dataframe_format=False, **kwargs):
+    _set_cache_db_match_func()
+    feature_new_rec = _get_db_feature(field, where_param, ret=ret, dataframe_format=dataframe_format, **kwargs)
+    # single-flight: the same query issued concurrently by threads or worker processes only hits the database once
+    with cache_db.single_flight(feature_new_rec) as record_info_cached:
+        if record_info_cached:
+            result = dict(record_info_cached).get("result", None)
+            return result
+
+        batch_group_key = _get_batch_group_key(field, where_param, ret=ret, dataframe_format=dataframe_format, **kwargs)
+        if DB_LOOKUP_COALESCING and batch_group_key is not None:
+            # the lookups of the same field and key columns issued concurrently are coalesced into batch queries
+            result, query_failed = db_lookup_coalescer.lookup(batch_group_key, _get_where_key(where_param), where_param)
+        else:
+            result, query_failed = __query_field_from_db(field, where_param, ret=ret,
+                                                         dataframe_format=dataframe_format, **kwargs)
+        if not query_failed:  # the empty results are cached as negative results
+            new_record = dict(**feature_new_rec, **{"result": result})
+            cache_db.add_record(new_record)
     return result
 
 
+# 3. batched lookups: one `WHERE (k1, k2) IN (...)` query with any() aggregation for many keys instead of a
+#   `SELECT ... LIMIT 1` query for each key.
+DB_LOOKUP_COALESCING = True
+DB_LOOKUP_MAX_BATCH_SIZE = 1000
+
+
+def _trim_where_param(where_param):
+    if "platform" not in where_param.keys():
+        where_param = dict({"platform": 'GitHub'}, **where_param)
+    return {k: v for k, v in where_param.items() if v is not None}
+
+
+def _get_where_key(where_param):
+    return tuple((k, str(v)) for k, v in sorted(_trim_where_param(where_param).items()))
+
+
+def _quote_sql_value(v):
+    return "'" + str(v).replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+
+# The lookups with the same group key can be queried in a batch: a single column field of the equality conditions,
+#   with ret='any' and the default table. return None if the lookup can not be batched.
+def _get_batch_group_key(field, where_param, ret='any', dataframe_format=False, **kwargs):
+    if ret != 'any' or dataframe_format or kwargs or not re.match(r'^[A-Za-z_][\w.]*$', str(field)):
+        return None
+    where_param_trimed = _trim_where_param(where_param)
+    if field in where_param_trimed.keys():
+        return None
+    for k, v in where_param_trimed.items():
+        if get_params_condition({k: v}) != f"{k}='{v}'" or "'" in str(v) or '\\' in str(v):
+            return None  # not a plain equality condition
+    return field, tuple(sorted(where_param_trimed.keys()))
+
+
+def __query_fields_from_db_batch(field, where_params):
+    # return: ({where_key: result}, query_failed), the keys not found are left out
+    where_params_trimed = [_trim_where_param(where_param) for where_param in where_params]
+    columns = sorted(where_params_trimed[0].keys())
+    const_columns = [c for c in columns if len(set(str(p[c]) for p in where_params_trimed)) == 1]
+    key_columns = [c for c in columns if c not in const_columns] or const_columns[-1:]
+    const_columns = [c for c in const_columns if c not in key_columns]
+    d_key_values = OrderedDict((tuple(str(p[c]) for c in key_columns), None) for p in where_params_trimed)
+    in_values = ', '.join('(' + ', '.join(_quote_sql_value(v) for v in key_values) + ')'
+                          for key_values in d_key_values.keys())
+    key_condition = f"({', '.join(key_columns)}) IN ({in_values})"
+    params_condition = get_params_condition({c: where_params_trimed[0][c] for c in const_columns})
+    sql_params = {
+        "columns": f"{', '.join(key_columns)}, any({field}) AS _value",
+        "table": 'opensource.events',
+        "where": f"{params_condition} AND {key_condition}" if params_condition else key_condition,
+        "group_by": ', '.join(key_columns),
+    }
+    sql = format_sql(sql_params)
+
+    conndb = ConnDB()
+    conndb.sql = sql
+    query_failed = False
+    try:
+        conndb.execute()
+    except BaseException as e:
+        query_failed = True
+        print(f"An unexpected error occurred: {e.__class__.__name__}! The query sql: {sql[:500]}.")
+    df_rs = pd.DataFrame() if conndb.rs is None else conndb.rs
+    d_results = {}
+    if len(df_rs):
+        ser_value = df_rs['_value']
+        l_key_values = zip(*[df_rs[c].astype(str) for c in key_columns])
+        d_value_by_key_values = {}
+        for i, key_values in enumerate(l_key_values):
+            result = ser_value.iloc[i]
+            if type(result) == list:
+                result = result[0]
+            d_value_by_key_values[tuple(key_values)] = result
+        for where_param, where_param_trimed in zip(where_params, where_params_trimed):
+            key_values = tuple(str(where_param_trimed[c]) for c in key_columns)
+            if key_values in d_value_by_key_values:
+                d_results[_get_where_key(where_param)] = d_value_by_key_values[key_values]
+    return d_results, query_failed
+
+
+# group_key: see _get_batch_group_key; where_params: the where_param dicts with the same group key.
+# return: ({where_key: result}, query_failed), the results of the keys not found are None.
+def _query_db_lookup_batch(group_key, where_params):
+    field = group_key[0]
+    if len(where_params) == 1:
+        result, query_failed = __query_field_from_db(field, where_params[0])
+        return {_get_where_key(where_params[0]): result}, query_failed
+    return __query_fields_from_db_batch(field, where_params)
+
+
+# Coalesce the lookups of the same group key: a lookup is queried at once if no batch of its group is running, otherwise
+#   it is queued, and the queued lookups are queried in one batch when the running one returns. So a single thread
+#   never waits, while the lookups issued concurrently, e.g. by the link resolution threads, share the batch queries.
+class DBLookupCoalescer:
+    def __init__(self, batch_func, max_batch_size=None):
+        self.batch_func = batch_func
+        self.max_batch_size = max_batch_size or DB_LOOKUP_MAX_BATCH_SIZE
+        self._groups = {}  # {group_key: {"pending": OrderedDict({key: slot}), "running": bool}}
+        self._cond = threading.Condition(threading.Lock())
+        self.n_lookups = 0
+        self.n_batches = 0
+
+    # return: (result, query_failed)
+    def lookup(self, group_key, key, request):
+        with self._cond:
+            self.n_lookups += 1
+            group = self._groups.setdefault(group_key, {"pending": OrderedDict(), "running": False})
+            slot = group["pending"].get(key)
+            if slot is None:
+                slot = {"request": request, "done": False, "result": None, "query_failed": False}
+                group["pending"][key] = slot
+            while not slot["done"]:
+                if group["running"]:
+                    self._cond.wait()
+                    continue
+                # lead the next batch of the queued lookups
+                batch = OrderedDict()
+                while group["pending"] and len(batch) < self.max_batch_size:
+                    k, s = group["pending"].popitem(last=False)
+                    batch[k] = s
+                group["running"] = True
+                self.n_batches += 1
+                self._cond.release()
+                d_results, query_failed = {}, True
+                try:
+                    d_results, query_failed = self.batch_func(group_key, [s["request"] for s in batch.values()])
+                finally:
+                    self._cond.acquire()
+                    group["running"] = False
+                    for k, s in batch.items():
+                        s.update({"done": True, "result": d_results.get(k), "query_failed": query_failed})
+                    self._cond.notify_all()
+            if not group["pending"] and not group["running"]:
+                self._groups.pop(group_key, None)
+            return slot["result"], slot["query_failed"]
+
+
+db_lookup_coalescer = DBLookupCoalescer(_query_db_lookup_batch)
+
+
+# Query the field of many where_params in batches, and add the results into cache_db, so that the later lookups of
+#   _get_field_from_db hit the cache. The where_params that can not be batched are queried one by one.
+# return: {tuple(where_param.values()): result}
+def _get_fields_from_db_batch(field, where_params):
+    _set_cache_db_match_func()
+    d_results = {}
+    d_group_where_params = OrderedDict()  # {group_key: [where_param]}
+    for where_param in where_params:
+        record_info_cached = cache_db.find_record_in_cache(_get_db_feature(field, where_param))
+        if record_info_cached:
+            d_results[tuple(where_param.values())] = dict(record_info_cached).get("result", None)
+            continue
+        group_key = _get_batch_group_key(field, where_param)
+        if group_key is None:
+            d_results[tuple(where_param.values())] = _get_field_from_db(field, where_param)
+        else:
+            d_group_where_params.setdefault(group_key, []).append(where_param)
+    for group_key, group_where_params in d_group_where_params.items():
+        for i in range(0, len(group_where_params), DB_LOOKUP_MAX_BATCH_SIZE):
+            batch_where_params = group_where_params[i: i + DB_LOOKUP_MAX_BATCH_SIZE]
+            d_batch_results, query_failed = _query_db_lookup_batch(group_key, batch_where_params)
+            for where_param in batch_where_params:
+                result = d_batch_results.get(_get_where_key(where_param))
+                if not query_failed:
+                    cache_db.add_record(dict(**_get_db_feature(field, where_param), **{"result": result}))
+                d_results[tuple(where_param.values())] = result
+    return d_results
+
+
+def _is_negative_db_record(record):
+    result = dict(record).get("result", None)
+    return result is None or (isinstance(result, (pd.DataFrame, pd.Series)) and not len(result))
+
+
+def _is_negative_api_record(record):
+    response = dict(record).get("response", None)
+    return response is None or getattr(response, "status_code", None) == 404
+
+
+API_CACHE_TTL = 86400
+
+
+# Use the disk-backed cache tier for the DB queries and the GitHub API requests, the results are shared across runs.
+#   path: the sqlite3 database file; kwargs: see PersistentCacheStore, e.g. ttl, negative_ttl, max_entries.
+# api_ttl: the persisted GitHub API responses expire after api_ttl seconds, then the REST requests are revalidated by
+#   their ETag/Last-Modified validators, a 304 response reuses the stored response without using the rate limit.
+def enable_persistent_cache(path, api_ttl=API_CACHE_TTL, **kwargs):
+    persistent_store = PersistentCacheStore(path, **kwargs)
+    cache_db.set_persistent_store(persistent_store, 'db', is_negative=_is_negative_db_record)
+    RequestGitHubAPI.cache.set_persistent_store(persistent_store, 'github_rest_api', is_negative=_is_negative_api_record,
+                                                ttl=api_ttl)
+    GitHubGraphQLAPI.cache.set_persistent_store(persistent_store, 'github_graphql_api',
+                                                is_negative=_is_negative_api_record, ttl=api_ttl)
+    RequestGitHubAPI.set_etag_store(persistent_store, 'github_rest_etag')
+    return persistent_store
+
+
 def get_actor_id_by_actor_login(actor_login, use_loc_table=USE_LOC_ACTOR_REPO_TABLE):
     if actor_login is None:
         return None
@@ -600,6 +600,18 @@ class ObjEntity(object):
         args = inspect.signature(lambda_func).parameters
         return [getattr(self, arg, None) for arg in args]
 
+    # The entity definition holds the lambdas in 'F', rebuild it from ObjEntity.E instead of pickling, e.g. the objects
+    #   cached in the PersistentCacheStore.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_ObjEntity__entity_def", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        node_type = self.__type__raw.split(ObjEntity.nt_label_delimiter)[0] if isinstance(self.__type__raw, str) else None
+        self.__entity_def = dict(ObjEntity.E.get(node_type, {}))
+
     def __getattr__(self, name):
         try:
             return self.__getattribute__(name)
@@ -36,6 +36,33 @@ def get_df_bodyRegLinks_eachLinkPatType(df_local_msg, use_msg_columns=None):
     return df_bodyRegLinks_eachLinkPatType
 
 
+# Entity Recognition in batch mode: recognize the body links of all records in a repo DataFrame at once.
+# The index of df_local_msg must be unique, the links of each record can be got by its index:
+#   {index: {link_pattern_type: body_regexed_links}}, the records without any link are omitted.
+def get_d_bodyRegLinks_eachLinkPatType_by_index(df_local_msg, use_msg_columns=None):
+    use_msg_columns = use_msg_columns or ['issue_title', 'body', 'push_commits.message', 'release_body']
+    use_msg_columns = [c for c in use_msg_columns if c in df_local_msg.columns]
+    rec_key = '_rec_index'  # union the regexed results of each record on its unique index rather than the event `id`
+    df_local_msg_use = df_local_msg[use_msg_columns].copy()
+    df_local_msg_use[rec_key] = df_local_msg_use.index
+    df_bodyRegLinks_eachLinkPatType = pd.DataFrame()
+    if len(df_local_msg_use) and len(use_msg_columns):
+        df_local_msg_regexed_dict = get_df_local_msg_regexed_dict(df_local_msg_use, use_msg_columns=use_msg_columns,
+                                                                  record_key=rec_key)
+        for link_pattern_type, df_local_msg_regexed in df_local_msg_regexed_dict.items():
+            temp_ser = pd.Series([], dtype=object)
+            if len(df_local_msg_regexed):
+                temp_ser = df_local_msg_regexed[use_msg_columns].apply(lambda rec: merge_links_in_records(rec, use_msg_columns), axis=1)
+            temp_df = pd.Series(temp_ser, name=link_pattern_type).to_frame()
+            df_bodyRegLinks_eachLinkPatType = df_bodyRegLinks_eachLinkPatType.merge(temp_df, left_index=True, right_index=True, how='outer')
+
+    d_bodyRegLinks_eachLinkPatType_by_index = {}
+    for index, linkPatType_body_regexed_links_dict in df_bodyRegLinks_eachLinkPatType.to_dict('index').items():
+        d_bodyRegLinks_eachLinkPatType_by_index[index] = {k: v for k, v in linkPatType_body_regexed_links_dict.items()
+                                                          if isinstance(v, list)}
+    return d_bodyRegLinks_eachLinkPatType_by_index
+
+
 if __name__ == '__main__':
     from GH_CoRE.model.tst_case import df_tst
 
@@ -6,22 +6,34 @@
 # @Author : 'Lou Zehua'
 # @File   : Relation_extraction.py
 
+import ast
 import copy
+import inspect
+import json
+import logging
 import os
+import re
+import time
+from collections import OrderedDict
+from concurrent.futures import as_completed
 from functools import partial
 
 import pandas as pd
 
-from GH_CoRE.model import ER_config_parser
-from GH_CoRE.model.Attribute_getter import _get_field_from_db
+from GH_CoRE.model import Attribute_getter, ER_config_parser
+from GH_CoRE.model.Attribute_getter import _get_field_from_db, _get_fields_from_db_batch
 from GH_CoRE.model.ER_config_parser import eventType_params2repr, match_substr__from_body, relation_type_filter, \
-    eventType_params, columns_df_ref_tuples_raw
-from GH_CoRE.model.Entity_model import ObjEntity
-from GH_CoRE.model.Entity_recognition import get_df_bodyRegLinks_eachLinkPatType
+    eventType_params, columns_df_ref_tuples_raw, get_eventType_params_from_joined_str
+from GH_CoRE.model.Entity_model import ObjEntity, _trim_refs_heads
+from GH_CoRE.model.Entity_recognition import get_df_bodyRegLinks_eachLinkPatType, \
+    get_d_bodyRegLinks_eachLinkPatType_by_index
 from GH_CoRE.model.Entity_search import get_ent_obj_in_link_text
 from GH_CoRE.model.Event_model import Event
 from GH_CoRE.model.Relation_model import Relation, get_relation_label_repr
 from GH_CoRE.utils.cache import QueryCache
+from GH_CoRE.utils.request_api import GitHubRequestExecutor, RateLimitDeferral, RateLimitDeferred
+
+logger = logging.getLogger(__name__)
 
 
 def get_df_and_dict_format_record(record):
@@ -47,6 +59,8 @@ def get_df_and_dict_format_record(record):
 def match_eventType_params_with_record(eventType_params_patterns, record):
     if isinstance(record, pd.DataFrame):
         record = record.to_dict("records")[0]
+    if eventType_params_patterns is eventType_params:  # the default patterns are precompiled
+        return event_trigger_dispatcher.match(record)
     record = dict(record)
     matched_pattern = None
     for eventType_params_pattern in eventType_params_patterns:
@@ -68,7 +82,410 @@ def match_eventType_params_with_record(eventType_params_patterns, record):
     return matched_pattern
 
 
-def get_obj_collaboration_tuples_from_record(record, extract_mode=3, cache=None, use_relation_type_list=None):
+# Precompiled dispatch of the event triggers in ER_config.event_trigger_ERE_triples_dict:
+#   match(record): the matched eventType_params pattern of a record, memoized by the event type and its trigger params;
+#   get_trigger_plans(event_trigger): the triple plans of an event trigger with the from-body flags and the prebuilt Relation.
+class EventTriggerDispatcher:
+    memo_max_size = 100000
+
+    def __init__(self, eventType_params_patterns=None):
+        self.eventType_params_patterns = eventType_params_patterns if eventType_params_patterns is not None else eventType_params
+        self._d_type_patterns = {}  # {event_type: [(params_items, eventType_params_pattern)]} in the order of the patterns
+        self._d_type_param_keys = {}  # {event_type: (param_key, ...)}
+        self._d_type_column_matchers = {}  # {event_type: [(accepted_values_items, eventType_params_pattern)]}
+        for eventType_params_pattern in self.eventType_params_patterns:
+            eventType = eventType_params_pattern[0]
+            params = dict(eventType_params_pattern[1] or {}) if len(eventType_params_pattern) > 1 else {}
+            self._d_type_patterns.setdefault(eventType, []).append((list(params.items()), eventType_params_pattern))
+            param_keys = self._d_type_param_keys.get(eventType, ())
+            self._d_type_param_keys[eventType] = param_keys + tuple(k for k in params.keys() if k not in param_keys)
+            # the values matched with each param in columns, the param values 'True'/'False' also match the booleans
+            accepted_values_items = [(k, [v, v == 'True'] if v in ['True', 'False'] else [v])
+                                     for k, v in params.items()]
+            self._d_type_column_matchers.setdefault(eventType, []).append(
+                (accepted_values_items, eventType_params_pattern))
+        self._match_memo = {}
+        self._df_ref_tuples_raw = None
+        self._d_trigger_plans = {}
+        self._d_trigger_plans_filtered = {}
+
+    @staticmethod
+    def _param_matched(v, x):
+        is_matched = (v == x)
+        if v in ['True', 'False']:
+            is_matched = is_matched or ((v == 'True') == x)
+        return is_matched
+
+    def _match_params(self, eventType, d_param_vals):
+        for params_items, eventType_params_pattern in self._d_type_patterns.get(eventType, []):
+            if all(self._param_matched(v, d_param_vals.get(k)) for k, v in params_items):
+                return eventType_params_pattern
+        return None
+
+    def match(self, record):
+        eventType = record['type']
+        param_keys = self._d_type_param_keys.get(eventType)
+        if param_keys is None:
+            return None
+        d_param_vals = {k: record.get(k, None) for k in param_keys}
+        # NaN is normalized to None, which are both not matched with any param value
+        memo_key = (eventType,) + tuple(None if ObjEntity.val_is_na(v) else v for v in d_param_vals.values())
+        try:
+            return self._match_memo[memo_key]
+        except KeyError:
+            pass
+        except TypeError:  # unhashable values
+            return self._match_params(eventType, d_param_vals)
+        matched_pattern = self._match_params(eventType, d_param_vals)
+        if len(self._match_memo) < EventTriggerDispatcher.memo_max_size:
+            self._match_memo[memo_key] = matched_pattern
+        return matched_pattern
+
+    # The columnar version of match: the event trigger repr of each record, None for the records without any matched
+    #   event trigger.
+    def match_columns(self, df_records):
+        ser_event_trigger = pd.Series([None] * len(df_records), index=df_records.index, dtype=object)
+        matched = pd.Series(False, index=df_records.index)
+        for eventType, column_matchers in self._d_type_column_matchers.items():
+            mask_type = df_records['type'] == eventType
+            if not mask_type.any():
+                continue
+            for accepted_values_items, eventType_params_pattern in column_matchers:
+                mask = mask_type & ~matched
+                for k, accepted_values in accepted_values_items:
+                    if k not in df_records.columns:
+                        mask = mask & False
+                        break
+                    mask = mask & df_records[k].isin(accepted_values)
+                if mask.any():
+                    ser_event_trigger[mask] = eventType_params2repr(eventType_params_pattern[0],
+                                                                    eventType_params_pattern[1])
+                matched = matched | mask
+        return ser_event_trigger
+
+    def _build_trigger_plans(self):
+        self._df_ref_tuples_raw = ER_config_parser.df_ref_tuples_raw
+        self._d_trigger_plans = {}
+        self._d_trigger_plans_filtered = {}
+        for matched_ref_pattern_dict in self._df_ref_tuples_raw.to_dict("records"):
+            src_nt = matched_ref_pattern_dict["source_node_label"]
+            tar_nt = matched_ref_pattern_dict["target_node_label"]
+            trigger_plan = dict(matched_ref_pattern_dict, **{
+                "match_src_nt_from_body": match_substr__from_body(src_nt),  # src_nt包含子串"from_body"标志
+                "match_tar_nt_from_body": match_substr__from_body(tar_nt),  # tar_nt包含子串"from_body"标志
+                "relation": Relation.get(relation_label_repr=get_relation_label_repr(matched_ref_pattern_dict)),
+            })
+            self._d_trigger_plans.setdefault(matched_ref_pattern_dict["event_trigger"], []).append(trigger_plan)
+
+    def get_trigger_plans(self, event_trigger, use_relation_type_list=None):
+        if self._df_ref_tuples_raw is not ER_config_parser.df_ref_tuples_raw:  # rebuild when the config is reloaded
+            self._build_trigger_plans()
+        if use_relation_type_list is None:
+            return self._d_trigger_plans.get(event_trigger, [])
+        plans_key = (event_trigger, tuple(use_relation_type_list))
+        trigger_plans = self._d_trigger_plans_filtered.get(plans_key)
+        if trigger_plans is None:
+            trigger_plans = [plan for plan in self._d_trigger_plans.get(event_trigger, [])
+                             if relation_type_filter(plan[columns_df_ref_tuples_raw[2]], use_relation_type_list)]
+            self._d_trigger_plans_filtered[plans_key] = trigger_plans
+        return trigger_plans
+
+
+event_trigger_dispatcher = EventTriggerDispatcher()
+
+
+columns_df_collaboration = ["src_entity_id", "src_entity_type", "tar_entity_id", "tar_entity_type", "relation_label_id",
+                            "relation_type", "relation_label_repr", "event_id", "event_trigger", "event_type", "event_time"]
+columns_df_collaboration_extend_field = ["tar_entity_match_text", "tar_entity_match_pattern_type", "tar_entity_objnt_prop_dict"]
+
+
+# The functions in the node labels which only depend on the record fields, e.g. 'Branch::branch_name=_trim_refs_heads(push_ref)'.
+# The node labels with other functions, e.g. __get_tag_commit_sha, have to query the API in the per-record path.
+columnar_node_label_funcs = {
+    "_trim_refs_heads": _trim_refs_heads,
+}
+
+
+# The columnar version of ObjEntity(node_label).set_val(d_record) in init_mode 'build_id', returns the PK values of the node
+#   entities as a pd.Series. Only the exid PKs built by Obj_exid.get_exid are computed, the other missing PKs which need
+#   querying the db or GitHub API are set None. Returns None when the node label cannot be evaluated in columns.
+def get_ser_entity_PK(df_records, node_label):
+    node_type = node_label.split(ObjEntity.nt_label_delimiter)[0]
+    entity_def = dict(ObjEntity.E.get(node_type, {}))
+    PKs = [p[:-len('(PK)')] for p in entity_def.get('U_K') or set() if p.endswith('(PK)')]
+    if not PKs:
+        return None
+    PK = PKs[0]
+    ser_none = pd.Series([None] * len(df_records), index=df_records.index, dtype=object)
+    d_ser_attrs = {}
+
+    def get_ser_attr(k):
+        if k in d_ser_attrs.keys():
+            return d_ser_attrs[k]
+        if k not in df_records.columns:
+            return ser_none
+        return df_records[k].where(df_records[k].map(bool), None)  # set_val only takes the values judged as True
+
+    if node_label.__contains__(ObjEntity.nt_label_delimiter):  # e.g. 'Commit::commit_sha=commit_comment_sha'
+        _, d_params = get_eventType_params_from_joined_str(node_label, delimiter=ObjEntity.nt_label_delimiter)
+        for k, v in d_params.items():
+            ser_attr_k = get_ser_attr(k)
+            if v in df_records.columns:
+                d_ser_attrs[k] = df_records[v].where(df_records[v].map(bool), ser_attr_k)
+            elif str(v).startswith("_") and str(v).endswith(")"):  # e.g. _trim_refs_heads(push_ref)
+                func_call = re.findall(r"^([_a-zA-Z0-9]+)\(\s*([_a-zA-Z0-9]+)\s*\)$", str(v))
+                func = columnar_node_label_funcs.get(func_call[0][0]) if func_call else None
+                if func is None:
+                    return None
+
+                def _apply_func(x, default_val):
+                    try:
+                        return func(x)
+                    except BaseException:
+                        return default_val
+                d_ser_attrs[k] = pd.Series([_apply_func(x, x_k) for x, x_k in zip(get_ser_attr(func_call[0][1]), ser_attr_k)],
+                                           index=df_records.index, dtype=object)
+            else:
+                d_ser_attrs[k] = ser_attr_k
+
+    ser_PK = get_ser_attr(PK).copy()
+    PK_na = ser_PK.map(ObjEntity.val_is_na)
+    if PK_na.any():
+        PK_func = dict(entity_def.get('F') or {}).get(PK)
+        if PK.startswith('_') and PK.endswith('_exid') and PK_func is not None:  # built by Obj_exid.get_exid without query
+            args = inspect.signature(PK_func).parameters
+            ser_args_list = [get_ser_attr(arg)[PK_na] for arg in args]
+            ser_PK[PK_na] = pd.Series([PK_func(*vals) for vals in zip(*ser_args_list)], index=ser_PK[PK_na].index, dtype=object)
+        else:
+            ser_PK[PK_na] = None
+    return ser_PK
+
+
+# EventAction relations in columns: group the records by the matched event trigger and build all the EventAction relations
+#   of each group with DataFrame column operations, which is equivalent to get_obj_collaboration_tuples_from_record with
+#   extract_mode=2 followed by get_df_collaboration.
+# Returns (df_collaboration, d_record_ext_by_index, fallback_indexes):
+#   df_collaboration: indexed by the index of df_records and ordered as the per-record path;
+#   d_record_ext_by_index: the source entity PKs which the per-record path adds into d_record, e.g. {index: {'_push_exid': ...}};
+#   fallback_indexes: the records with missing PKs or event fields which need the per-record path to query the db or API.
+def get_df_collaboration_EventAction(df_records, use_relation_type_list=None, extend_field=True):
+    columns = columns_df_collaboration
+    if extend_field:
+        columns = columns + columns_df_collaboration_extend_field
+    df_records = df_records.astype(object)
+    ser_event_trigger = event_trigger_dispatcher.match_columns(df_records)
+    ser_record_loc = pd.Series(range(len(df_records)), index=df_records.index)
+    # Event(...) queries the db when the event id or event time is missing
+    mask_event_valid = ser_event_trigger.notna() & df_records['id'].map(lambda x: x is not None) & \
+        df_records['created_at'].map(bool)
+    fallback_indexes = list(df_records.index[~mask_event_valid])
+
+    df_collaboration_list = []
+    d_record_ext_by_index = {}
+    for event_trigger, df_group in df_records[mask_event_valid].groupby(ser_event_trigger[mask_event_valid], sort=False):
+        df_work = df_group.copy()
+        df_group_collaboration_list = []
+        mask_PK_valid = pd.Series(True, index=df_work.index)
+        group_fallback = False
+        trigger_plans = event_trigger_dispatcher.get_trigger_plans(event_trigger, use_relation_type_list)
+        for pattern_loc, trigger_plan in enumerate(trigger_plans):
+            src_nt = trigger_plan["source_node_label"]
+            tar_nt = trigger_plan["target_node_label"]
+            if trigger_plan["match_src_nt_from_body"] or trigger_plan["match_tar_nt_from_body"]:
+                continue
+            relation = trigger_plan["relation"]
+            ser_src_PK = get_ser_entity_PK(df_work, src_nt)
+            if ser_src_PK is None:
+                group_fallback = True
+                break
+            src_type = src_nt.split(ObjEntity.nt_label_delimiter)[0]
+            src_PK = ObjEntity(src_type).__PK__
+            if src_PK not in df_work.columns:  # the per-record path adds the source entity PK into d_record
+                df_work[src_PK] = ser_src_PK
+                for index, val in ser_src_PK.items():
+                    d_record_ext_by_index.setdefault(index, {})[src_PK] = val
+            ser_tar_PK = get_ser_entity_PK(df_work, tar_nt)
+            if ser_tar_PK is None:
+                group_fallback = True
+                break
+            tar_type = tar_nt.split(ObjEntity.nt_label_delimiter)[0]
+            mask_PK_valid = mask_PK_valid & ser_src_PK.notna() & ser_tar_PK.notna()
+
+            df_pattern_collaboration = pd.DataFrame(index=df_work.index, columns=columns, dtype=object)
+            df_pattern_collaboration["src_entity_id"] = ObjEntity(src_type)._type_abbr + '_' + ser_src_PK.map(str)
+            df_pattern_collaboration["src_entity_type"] = src_type
+            df_pattern_collaboration["tar_entity_id"] = ObjEntity(tar_type)._type_abbr + '_' + ser_tar_PK.map(str)
+            df_pattern_collaboration["tar_entity_type"] = tar_type
+            df_pattern_collaboration["relation_label_id"] = relation.relation_label_id
+            df_pattern_collaboration["relation_type"] = relation.relation_type
+            df_pattern_collaboration["relation_label_repr"] = relation.relation_label_repr
+            df_pattern_collaboration["event_id"] = df_work['id']
+            df_pattern_collaboration["event_trigger"] = event_trigger
+            df_pattern_collaboration["event_type"] = get_eventType_params_from_joined_str(event_trigger)[0]
+            df_pattern_collaboration["event_time"] = df_work['created_at'].map(
+                lambda t: t.strftime('%Y-%m-%d %H:%M:%S') if isinstance(t, pd.Timestamp) else t)
+            if extend_field:
+                for c in columns_df_collaboration_extend_field:
+                    df_pattern_collaboration[c] = None
+            df_pattern_collaboration["_record_loc"] = ser_record_loc[df_work.index]
+            df_pattern_collaboration["_pattern_loc"] = pattern_loc
+            df_group_collaboration_list.append(df_pattern_collaboration)
+        if group_fallback:
+            fallback_indexes += list(df_group.index)
+            continue
+        fallback_indexes += list(df_work.index[~mask_PK_valid])
+        df_collaboration_list += [df[mask_PK_valid] for df in df_group_collaboration_list]
+
+    fallback_indexes_set = set(fallback_indexes)
+    d_record_ext_by_index = {k: v for k, v in d_record_ext_by_index.items() if k not in fallback_indexes_set}
+    if not len(df_collaboration_list):
+        return pd.DataFrame(columns=columns), d_record_ext_by_index, fallback_indexes
+    df_collaboration = pd.concat(df_collaboration_list)
+    df_collaboration = df_collaboration.sort_values(["_record_loc", "_pattern_loc"], kind='stable')
+    df_collaboration = df_collaboration[columns]
+    return df_collaboration, d_record_ext_by_index, fallback_indexes
+
+
+# The feature of a body link to be searched, the link cache and the resolved links are both keyed by it.
+def get_link_feature(link_pattern_type, link_text, d_record):
+    return {"link_pattern_type": link_pattern_type, "link_text": link_text, "rec_repo_id": d_record.get("repo_id")}
+
+
+def get_link_feature_key(feature):
+    return tuple(feature.values())
+
+
+# Search the entity of a link, raise RateLimitDeferred if any GitHub request of the search has to wait for the rate limit
+#   reset. The result of a deferred search is discarded even if the callee caught the exception.
+def get_ent_obj_in_link_text_deferrable(link_pattern_type, link_text, d_record):
+    with RateLimitDeferral() as deferral:
+        obj_nt_from_body = get_ent_obj_in_link_text(link_pattern_type, link_text, d_record)
+    if deferral.deferred:
+        raise RateLimitDeferred(deferral.resource, deferral.reset)
+    return obj_nt_from_body
+
+
+# Search the entity of a body link through the link cache, the same link searched concurrently by threads or worker
+#   processes sharing a persistent store is only searched once, see QueryCache.single_flight.
+# defer: raise RateLimitDeferred rather than wait for the rate limit reset, see get_ent_obj_in_link_text_deferrable.
+def get_ent_obj_in_link_text_cached(feature_new_rec, d_record, cache, defer=False):
+    with cache.single_flight(feature_new_rec) as record_info_cached:
+        if record_info_cached:
+            # print(f"find new record in cache: {record_info_cached}")
+            obj_nt_from_body = dict(record_info_cached).get("obj_nt_from_body", ObjEntity(ObjEntity.default_type))
+        else:
+            search_func = get_ent_obj_in_link_text_deferrable if defer else get_ent_obj_in_link_text
+            obj_nt_from_body = search_func(feature_new_rec["link_pattern_type"], feature_new_rec["link_text"], d_record)
+            new_record = dict(**feature_new_rec, **{"obj_nt_from_body": obj_nt_from_body})
+            cache.add_record(new_record)
+    return obj_nt_from_body
+
+
+# Two-phase link resolution, phase 1: scan the records and collect the distinct body links to be searched.
+#   Only the records whose event trigger has the body link patterns are scanned, the first record where a link occurs is
+#   kept as its context d_record, which is the same one used by the cache of the record-by-record extraction.
+# d_bodyRegLinks_eachLinkPatType_by_index: the body links by record index, see get_d_bodyRegLinks_eachLinkPatType_by_index.
+# d_record_ext_by_index: the extended fields of the records, see get_df_collaboration_EventAction.
+# return: OrderedDict {link_feature_key: (link_feature, d_record)}, the links found in the cache are skipped.
+def collect_unresolved_links(df_records, d_bodyRegLinks_eachLinkPatType_by_index=None, use_relation_type_list=None,
+                             d_record_ext_by_index=None, cache=None):
+    if d_bodyRegLinks_eachLinkPatType_by_index is None:
+        d_bodyRegLinks_eachLinkPatType_by_index = get_d_bodyRegLinks_eachLinkPatType_by_index(df_records)
+    d_record_ext_by_index = d_record_ext_by_index or {}
+    d_unresolved_links = OrderedDict()
+    for index, linkPatType_body_regexed_links_dict in d_bodyRegLinks_eachLinkPatType_by_index.items():
+        if index not in df_records.index or not len(linkPatType_body_regexed_links_dict):
+            continue
+        d_record = dict(df_records.loc[index].to_dict(), **d_record_ext_by_index.get(index, {}))
+        matched_eventType_params = match_eventType_params_with_record(eventType_params, d_record)
+        matched_eventType_params_repr = eventType_params2repr(matched_eventType_params[0], matched_eventType_params[1])
+        trigger_plans = event_trigger_dispatcher.get_trigger_plans(matched_eventType_params_repr, use_relation_type_list)
+        if not any(trigger_plan["match_tar_nt_from_body"] for trigger_plan in trigger_plans):
+            continue
+        for link_pattern_type, body_regexed_links in linkPatType_body_regexed_links_dict.items():
+            for link_text in body_regexed_links:
+                feature_new_rec = get_link_feature(link_pattern_type, link_text, d_record)
+                feature_key = get_link_feature_key(feature_new_rec)
+                if feature_key in d_unresolved_links:
+                    continue
+                if cache is not None and cache.find_record_in_cache(feature_new_rec):
+                    continue
+                d_unresolved_links[feature_key] = (feature_new_rec, d_record)
+    return d_unresolved_links
+
+
+# Two-phase link resolution, before phase 2: the repo names and actor logins in the collected links are known up front,
+#   query their repo_id and actor_id in batches into cache_db, so that the link searches hit the cache instead of
+#   issuing a query for each of them. The names which are the repo or actor of the context record are not searched.
+def prefetch_link_db_fields(d_unresolved_links):
+    if Attribute_getter.USE_LOC_ACTOR_REPO_TABLE:  # the local tables are looked up at first
+        return
+    repo_names = set()
+    actor_logins = set()
+    for feature, d_record in (v[:2] for v in d_unresolved_links.values()):
+        link_text = str(feature["link_text"])
+        for repo_name in re.findall(r'(?<=github\.com/)[A-Za-z0-9][-0-9a-zA-Z]*/[A-Za-z0-9][-_0-9a-zA-Z.]*', link_text):
+            if repo_name != d_record.get("repo_name"):
+                repo_names.add(repo_name)
+        if feature["link_pattern_type"] == "Actor":
+            actor_login = re.findall(r"(?<=com/)([A-Za-z0-9][-0-9a-zA-Z]*(?:\[bot\])?)(?![-A-Za-z0-9/])", link_text) or \
+                          re.findall(r"^@([A-Za-z0-9][-0-9a-zA-Z]*)$", link_text)
+            if actor_login and actor_login[0] != d_record.get("actor_login"):
+                actor_logins.add(actor_login[0])
+    if repo_names:
+        _get_fields_from_db_batch('repo_id', [{'repo_name': repo_name} for repo_name in sorted(repo_names)])
+    if actor_logins:
+        _get_fields_from_db_batch('actor_id', [{'actor_login': actor_login} for actor_login in sorted(actor_logins)])
+
+
+# Two-phase link resolution, phase 2: search the entities of the collected links concurrently, the ClickHouse queries
+#   and GitHub API requests of different links are issued by the thread pool of a GitHubRequestExecutor rather than one
+#   after another, which spreads the requests over the tokens of the token pool.
+# workers: the number of threads, set None to size the pool by the number of GitHub tokens.
+# return: {link_feature_key: obj_nt_from_body}, the links failed to be resolved are left out and will be searched again
+#   when the relations are emitted.
+# d_deferred_links: a dict to park the links whose search has to wait for the GitHub rate limit reset, rather than block
+#   the worker: {link_feature_key: (link_feature, d_record, reset)}. Set None to wait for the reset.
+def resolve_links(d_unresolved_links, workers=None, cache=None, d_deferred_links=None):
+    d_resolved_links = {}
+    if not len(d_unresolved_links):
+        return d_resolved_links
+    defer = d_deferred_links is not None
+    prefetch_link_db_fields(d_unresolved_links)
+    with GitHubRequestExecutor(max_workers=workers).get_thread_pool(len(d_unresolved_links)) as executor:
+        if cache is not None:  # add the resolved links into the cache, shared with the other workers by single-flight
+            future_to_key = {executor.submit(get_ent_obj_in_link_text_cached, feature, d_record, cache, defer): key
+                             for key, (feature, d_record) in d_unresolved_links.items()}
+        else:
+            search_func = get_ent_obj_in_link_text_deferrable if defer else get_ent_obj_in_link_text
+            future_to_key = {executor.submit(search_func, feature["link_pattern_type"], feature["link_text"],
+                                             d_record): key
+                             for key, (feature, d_record) in d_unresolved_links.items()}
+        for future in as_completed(future_to_key):
+            key = future_to_key[future]
+            try:
+                obj_nt_from_body = future.result()
+            except RateLimitDeferred as e:
+                feature, d_record = d_unresolved_links[key][:2]
+                d_deferred_links[key] = (feature, d_record, e.reset)
+                continue
+            except Exception as e:
+                logger.warning(f"Failed to resolve the link {key}: {e.__class__.__name__}: {e}. It will be searched "
+                               f"again when its record is processed.")
+                continue
+            d_resolved_links[key] = obj_nt_from_body
+    return d_resolved_links
+
+
+# Set linkPatType_body_regexed_links_dict as the precomputed body links of the record in batch mode, see
+#   Entity_recognition.get_d_bodyRegLinks_eachLinkPatType_by_index.
+# Set resolved_links as the links resolved in bulk (phase 3 of the two-phase link resolution), see resolve_links, the
+#   links not in it are searched through the cache.
+# Set defer=True to raise RateLimitDeferred when the record depends on a link in deferred_links, or on a link whose search
+#   has to wait for the GitHub rate limit reset, no tuple of the record is returned then.
+def get_obj_collaboration_tuples_from_record(record, extract_mode=3, cache=None, use_relation_type_list=None,
+                                             linkPatType_body_regexed_links_dict=None, resolved_links=None,
+                                             defer=False, deferred_links=None):
     if cache is None:
         cache = QueryCache(max_size=200)
         cache.match_func = partial(QueryCache.d_match_func, **{"feat_keys": ["link_pattern_type", "link_text", "rec_repo_id"]})
@@ -76,6 +493,7 @@ def get_obj_collaboration_tuples_from_record(record, extract_mode=3, cache=None,
     df_record, d_record = get_df_and_dict_format_record(record)
     if not len(df_record):
         return obj_collaboration_tuple_list
+    record_requeried = False  # the precomputed body links are outdated once the record is requeried from db
 
     # The 'extract_mode' should be in [0, 1, 2, 3]
     extract_ref_from_event, extract_ref_from_bodylink = bool(extract_mode & 0x2), bool(extract_mode & 0x1)
@@ -84,20 +502,15 @@ def get_obj_collaboration_tuples_from_record(record, extract_mode=3, cache=None,
     matched_eventType_params = match_eventType_params_with_record(eventType_params, d_record)
     matched_eventType_params_repr = eventType_params2repr(matched_eventType_params[0], matched_eventType_params[1])
     # 获得Event type的三元组模式
-    df_ref_tuples_raw = ER_config_parser.df_ref_tuples_raw
-    if use_relation_type_list is not None:
-        df_ref_tuples_raw = df_ref_tuples_raw[
-            df_ref_tuples_raw[columns_df_ref_tuples_raw[2]].apply(relation_type_filter, use_relation_type_list=use_relation_type_list)]
-    df_matched_ref_pattern = df_ref_tuples_raw[df_ref_tuples_raw['event_trigger'] == matched_eventType_params_repr]
+    trigger_plans = event_trigger_dispatcher.get_trigger_plans(matched_eventType_params_repr, use_relation_type_list)
     # 构建元组
-    for matched_ref_pattern_dict in df_matched_ref_pattern.to_dict("records"):
-        src_nt = matched_ref_pattern_dict["source_node_label"]
-        tar_nt = matched_ref_pattern_dict["target_node_label"]
-        match_src_nt_from_body = match_substr__from_body(src_nt)  # src_nt包含子串"from_body"标志
-        match_tar_nt_from_body = match_substr__from_body(tar_nt)  # tar_nt包含子串"from_body"标志
-        relation_label_repr = get_relation_label_repr(matched_ref_pattern_dict)
-        relation = Relation(relation_label_repr=relation_label_repr)
-        event = Event(event_id=d_record.get('id'), event_trigger=matched_ref_pattern_dict['event_trigger'],
+    for trigger_plan in trigger_plans:
+        src_nt = trigger_plan["source_node_label"]
+        tar_nt = trigger_plan["target_node_label"]
+        match_src_nt_from_body = trigger_plan["match_src_nt_from_body"]
+        match_tar_nt_from_body = trigger_plan["match_tar_nt_from_body"]
+        relation = trigger_plan["relation"]
+        event = Event(event_id=d_record.get('id'), event_trigger=trigger_plan['event_trigger'],
                       event_time=d_record.get('created_at'))
         if not match_src_nt_from_body and not match_tar_nt_from_body:
             if extract_ref_from_event:
@@ -113,6 +526,7 @@ def get_obj_collaboration_tuples_from_record(record, extract_mode=3, cache=None,
                     df_record_query = _get_field_from_db('*', where_param, dataframe_format=True)
                     if len(df_record_query):
                         df_record, d_record = get_df_and_dict_format_record(df_record_query)
+                        record_requeried = True
                         src_nt_obj.set_val(d_record)
                         tar_nt_obj.set_val(d_record)
                 temp_obj_collaboration_tuple = (src_nt_obj, tar_nt_obj, relation, event)
@@ -131,26 +545,31 @@ def get_obj_collaboration_tuples_from_record(record, extract_mode=3, cache=None,
                     df_record_query = _get_field_from_db('*', where_param, dataframe_format=True)
                     if len(df_record_query):
                         df_record, d_record = get_df_and_dict_format_record(df_record_query)
+                        record_requeried = True
                         obj_nt_from_fileds.set_val(d_record)
                 # 构建实体字典
                 # NER: 从body中抽取出link
-                df_bodyRegLinks_eachLinkPatType = get_df_bodyRegLinks_eachLinkPatType(df_record)
-                if len(df_bodyRegLinks_eachLinkPatType):
-                    linkPatType_body_regexed_links_dict = df_bodyRegLinks_eachLinkPatType.to_dict('records')[0]
+                if linkPatType_body_regexed_links_dict is None or record_requeried:
+                    df_bodyRegLinks_eachLinkPatType = get_df_bodyRegLinks_eachLinkPatType(df_record)
+                    if len(df_bodyRegLinks_eachLinkPatType):
+                        linkPatType_body_regexed_links_dict = df_bodyRegLinks_eachLinkPatType.to_dict('records')[0]
+                    else:
+                        linkPatType_body_regexed_links_dict = {}
+                if len(linkPatType_body_regexed_links_dict):
                     # 如何与正则匹配结合将类型nt和record查到
                     for link_pattern_type, body_regexed_links in linkPatType_body_regexed_links_dict.items():
                         if isinstance(body_regexed_links, list):  # 此record的body匹配到的link列表，否则只能是pd.isna
                             for link_text in body_regexed_links:
                                 # Entity Search
-                                feature_new_rec = {"link_pattern_type": link_pattern_type, "link_text": link_text, "rec_repo_id": d_record.get("repo_id")}
-                                record_info_cached = cache.find_record_in_cache(feature_new_rec)
-                                if record_info_cached:
-                                    # print(f"find new record in cache: {record_info_cached}")
-                                    obj_nt_from_body = dict(record_info_cached).get("obj_nt_from_body", ObjEntity(ObjEntity.default_type))
+                                feature_new_rec = get_link_feature(link_pattern_type, link_text, d_record)
+                                feature_key = get_link_feature_key(feature_new_rec)
+                                if resolved_links is not None and feature_key in resolved_links:
+                                    obj_nt_from_body = resolved_links[feature_key]
+                                elif defer and deferred_links is not None and feature_key in deferred_links:
+                                    raise RateLimitDeferred(reset=deferred_links[feature_key][-1])
                                 else:
-                                    obj_nt_from_body = get_ent_obj_in_link_text(link_pattern_type, link_text, d_record)
-                                    new_record = dict(**feature_new_rec, **{"obj_nt_from_body": obj_nt_from_body})
-                                    cache.add_record(new_record)
+                                    obj_nt_from_body = get_ent_obj_in_link_text_cached(feature_new_rec, d_record, cache,
+                                                                                       defer=defer)
 
                                 objnt_prop_dict = obj_nt_from_body.get_dict().get("objnt_prop_dict", None)
                                 duplicate_matching = False
@@ -174,32 +593,132 @@ def get_obj_collaboration_tuples_from_record(record, extract_mode=3, cache=None,
     return obj_collaboration_tuple_list, cache
 
 
+# Columnar builder of df_collaboration: collects the collaboration tuples of many records into column lists and
+#   materializes the DataFrame once. The rows can be labeled with the record index, and the EventAction rows built by
+#   get_df_collaboration_EventAction can be added in the same order as the per-record path.
+class CollaborationTableBuilder:
+    def __init__(self, extend_field=True):
+        self.extend_field = extend_field
+        self.columns = columns_df_collaboration
+        if extend_field:
+            self.columns = self.columns + columns_df_collaboration_extend_field
+        self.clear()
+
+    def clear(self):
+        self._d_columns = {c: [] for c in self.columns}
+        self._index = []
+
+    def __len__(self):
+        return len(self._index)
+
+    def add_tuples(self, obj_collaboration_tuple_list, index=None):
+        d_columns = self._d_columns
+        for obj_collaboration_tuple in obj_collaboration_tuple_list:
+            src_entity, tar_entity, relation, event = obj_collaboration_tuple[:4]
+            d_columns["src_entity_id"].append(
+                f"{src_entity._type_abbr}_{getattr(src_entity, src_entity.__PK__)}" if src_entity.__PK__ else None)
+            d_columns["src_entity_type"].append(src_entity.__type__)
+            d_columns["tar_entity_id"].append(
+                f"{tar_entity._type_abbr}_{getattr(tar_entity, tar_entity.__PK__)}" if tar_entity.__PK__ else None)
+            d_columns["tar_entity_type"].append(tar_entity.__type__)
+            d_columns["relation_label_id"].append(relation.relation_label_id)
+            d_columns["relation_type"].append(relation.relation_type)
+            d_columns["relation_label_repr"].append(relation.relation_label_repr)
+            d_columns["event_id"].append(event.event_id)
+            d_columns["event_trigger"].append(event.event_trigger)
+            d_columns["event_type"].append(event.event_type)
+            d_columns["event_time"].append(event.event_time)
+            if self.extend_field:  # only target entity can be referenced with text
+                d_columns["tar_entity_match_text"].append(getattr(tar_entity, "match_text", None))
+                d_columns["tar_entity_match_pattern_type"].append(getattr(tar_entity, "match_pattern_type", None))
+                d_columns["tar_entity_objnt_prop_dict"].append(getattr(tar_entity, "objnt_prop_dict", None))
+        self._index += [index] * len(obj_collaboration_tuple_list)
+
+    # records: the rows in the format of df_collaboration.to_dict('records')
+    def add_records(self, records, index=None):
+        for c, values in self._d_columns.items():
+            values += [record.get(c) for record in records]
+        self._index += [index] * len(records)
+
+    def to_dataframe(self, clear=False):
+        d_columns = dict(self._d_columns)
+        ser_event_time = pd.Series(d_columns["event_time"], dtype=object)
+        mask_timestamp = ser_event_time.map(lambda t: isinstance(t, pd.Timestamp))
+        if mask_timestamp.any():
+            ser_event_time[mask_timestamp] = pd.to_datetime(ser_event_time[mask_timestamp]).dt.strftime('%Y-%m-%d %H:%M:%S')
+        d_columns["event_time"] = ser_event_time.values
+        df_collaboration = pd.DataFrame(d_columns, columns=self.columns)
+        if any(index is not None for index in self._index):
+            df_collaboration.index = self._index
+        if clear:
+            self.clear()
+        return df_collaboration
+
+
+# Keep the relations of the records in order while the records depending on the links deferred by the GitHub rate limit
+#   are put off: a deferred record holds its place between the builders of the records around it, and is patched with a
+#   builder of its own relations when its links are resolved. Only the rows before the first deferred record are ready to
+#   be written, each builder carries the checkpoint of the last record added to it.
+class DeferredCollaborationBuffer:
+    def __init__(self, extend_field=True):
+        self.extend_field = extend_field
+        self._segments = [self._new_builder()]  # CollaborationTableBuilder or the index of a deferred record
+        self._deferred = OrderedDict()  # {index: [record, reset]}
+
+    def _new_builder(self):
+        builder = CollaborationTableBuilder(extend_field=self.extend_field)
+        builder.checkpoint = None
+        return builder
+
+    @property
+    def builder(self):
+        return self._segments[-1]
+
+    def __len__(self):
+        return sum(len(s) for s in self._segments if isinstance(s, CollaborationTableBuilder))
+
+    def n_deferred(self):
+        return len(self._deferred)
+
+    def get_deferred(self):
+        return [(index, record, reset) for index, (record, reset) in self._deferred.items()]
+
+    # the earliest time to retry the deferred records
+    def next_reset(self):
+        resets = [reset for _, reset in self._deferred.values() if reset is not None]
+        return min(resets) if resets else time.time()
+
+    def defer(self, index, record, reset=None):
+        if index in self._deferred:
+            self._deferred[index][1] = reset
+            return
+        self._deferred[index] = [record, reset]
+        self._segments.append(('deferred', index))
+        self._segments.append(self._new_builder())
+
+    # replace the place of the deferred record by the builder of its relations
+    def patch(self, index, builder):
+        pos = self._segments.index(('deferred', index))
+        self._segments[pos] = builder
+        del self._deferred[index]
+
+    # return: [(df_collaboration, checkpoint)] of the builders before the first deferred record
+    def pop_ready(self):
+        l_ready = []
+        while isinstance(self._segments[0], CollaborationTableBuilder):
+            builder = self._segments[0]
+            l_ready.append((builder.to_dataframe(clear=True), builder.checkpoint))
+            if len(self._segments) == 1:
+                break
+            self._segments.pop(0)
+        return l_ready
+
+
 # set extend_field=True if the uncertain type object links need to be saved.
 def get_df_collaboration(obj_collaboration_tuple_list, extend_field=True):
-    columns = ["src_entity_id", "src_entity_type", "tar_entity_id", "tar_entity_type", "relation_label_id",
-               "relation_type", "relation_label_repr", "event_id", "event_trigger", "event_type", "event_time"]
-    columns_extend_field = ["tar_entity_match_text", "tar_entity_match_pattern_type", "tar_entity_objnt_prop_dict"]
-    if extend_field:
-        columns = columns + columns_extend_field
-    df_collaboration = pd.DataFrame(columns=columns)
-    for obj_collaboration_tuple in obj_collaboration_tuple_list:
-        src_entity, tar_entity, relation, event = obj_collaboration_tuple[:4]
-        new_row = {
-            "src_entity_id": src_entity.__repr__(brief=True) if src_entity.__PK__ else None,
-            "src_entity_type": src_entity.__type__,
-            "tar_entity_id": tar_entity.__repr__(brief=True) if tar_entity.__PK__ else None,
-            "tar_entity_type": tar_entity.__type__,
-            "relation_label_id": relation.relation_label_id, "relation_type": relation.relation_type,
-            "relation_label_repr": relation.relation_label_repr,
-            "event_id": event.event_id, "event_trigger": event.event_trigger, "event_type": event.event_type,
-            "event_time": event.event_time.strftime('%Y-%m-%d %H:%M:%S') if isinstance(event.event_time, pd.Timestamp) else event.event_time
-        }
-        if extend_field:  # only target entity can be referenced with text
-            new_row["tar_entity_match_text"] = getattr(tar_entity, "match_text", None)
-            new_row["tar_entity_match_pattern_type"] = getattr(tar_entity, "match_pattern_type", None)
-            new_row["tar_entity_objnt_prop_dict"] = getattr(tar_entity, "objnt_prop_dict", None)
-        df_collaboration.loc[len(df_collaboration)] = new_row  # 添加新记录
-    return df_collaboration
+    builder = CollaborationTableBuilder(extend_field=extend_field)
+    builder.add_tuples(obj_collaboration_tuple_list)
+    return builder.to_dataframe()
 
 
 def save_GitHub_Collaboration_Network(df_collaboration, save_path, add_mode_if_exists=False,
@@ -218,6 +737,225 @@ def save_GitHub_Collaboration_Network(df_collaboration, save_path, add_mode_if_e
     return None
 
 
+# Rebuild the entity searched from a body link by a row of the collaboration table with extend_field=True, the PK is set
+#   from 'tar_entity_id' so that no query is issued. Return None if the row is not a body link reference.
+def get_obj_nt_from_body_by_collaboration_row(d_row):
+    match_text = d_row.get("tar_entity_match_text")
+    match_pattern_type = d_row.get("tar_entity_match_pattern_type")
+    if not isinstance(match_text, str) or not isinstance(match_pattern_type, str):
+        return None
+    objnt_prop_dict = d_row.get("tar_entity_objnt_prop_dict")
+    if isinstance(objnt_prop_dict, str):
+        try:
+            objnt_prop_dict = ast.literal_eval(objnt_prop_dict)
+        except (ValueError, SyntaxError):
+            return None
+    if not isinstance(objnt_prop_dict, dict):
+        objnt_prop_dict = None
+    nt = d_row.get("tar_entity_type")
+    nt = nt if isinstance(nt, str) else ObjEntity.default_type
+    d_val = dict(objnt_prop_dict or {})
+    d_val.update({"match_text": match_text, "match_pattern_type": match_pattern_type, "objnt_prop_dict": objnt_prop_dict})
+    ent_obj = ObjEntity(nt)
+    tar_entity_id = d_row.get("tar_entity_id")
+    if ent_obj.__PK__ and isinstance(tar_entity_id, str):
+        PK_value = ObjEntity.get_exid_from_obj_repr(tar_entity_id)
+        if ObjEntity.E.get(nt, {}).get('D', {}).get(ent_obj.__PK__ + '(PK)') == int:
+            try:
+                PK_value = int(PK_value)
+            except ValueError:
+                pass
+        d_val[ent_obj.__PK__] = PK_value
+    ent_obj.set_val(d_val)
+    return ent_obj
+
+
+# Get the link cache records from a collaboration table produced with extend_field=True, keyed like the feature of
+#   get_link_feature. The repo_id of the record where a link occurs is got by its event id from d_event_repo_id, or set
+#   as rec_repo_id by default, e.g. the repo_id of a single repo result file.
+def get_link_cache_records_from_df_collaboration(df_collaboration, d_event_repo_id=None, rec_repo_id=None):
+    d_event_repo_id = d_event_repo_id or {}
+    link_cache_records = []
+    feature_keys = set()
+    if not len(df_collaboration) or "tar_entity_match_text" not in df_collaboration.columns:
+        return link_cache_records
+    df_ref = df_collaboration[df_collaboration["tar_entity_match_text"].notna()]
+    for d_row in df_ref.to_dict('records'):
+        try:
+            event_id = int(d_row.get("event_id"))
+        except (TypeError, ValueError):
+            event_id = None
+        repo_id = d_event_repo_id.get(event_id, rec_repo_id)
+        if repo_id is None or pd.isna(repo_id):
+            continue
+        feature_new_rec = get_link_feature(d_row["tar_entity_match_pattern_type"], d_row["tar_entity_match_text"],
+                                           {"repo_id": repo_id})
+        feature_key = get_link_feature_key(feature_new_rec)
+        if feature_key in feature_keys:
+            continue
+        obj_nt_from_body = get_obj_nt_from_body_by_collaboration_row(d_row)
+        if obj_nt_from_body is None:
+            continue
+        feature_keys.add(feature_key)
+        link_cache_records.append(dict(**feature_new_rec, **{"obj_nt_from_body": obj_nt_from_body}))
+    return link_cache_records
+
+
+# Warm the link cache from a collaboration csv file produced before, e.g. before a rerun or an incremental update, so
+#   that the resolved links are not searched again. Return the number of links loaded into the cache.
+def warm_link_cache_from_csv(cache, csv_path, d_event_repo_id=None, rec_repo_id=None):
+    if cache is None or not os.path.exists(csv_path):
+        return 0
+    try:
+        df_collaboration = pd.read_csv(csv_path, dtype=str, keep_default_na=False, na_values=[''], encoding='utf-8')
+    except pd.errors.EmptyDataError:
+        return 0
+    link_cache_records = get_link_cache_records_from_df_collaboration(df_collaboration, d_event_repo_id=d_event_repo_id,
+                                                                      rec_repo_id=rec_repo_id)
+    if cache.max_size is not None and len(link_cache_records) > cache.max_size:
+        print(f"Warning: {len(link_cache_records)} links are loaded from {csv_path}, but only {cache.max_size} links "
+              f"can be kept in the link cache! Try a larger cache_max_size.")
+    for record in link_cache_records:
+        cache.add_record(record, skip_dup=False, persist=False)
+    return len(link_cache_records)
+
+
+# Checkpoint journal of a result file, e.g. '<repo_key>.csv.checkpoint.json': records the last committed record index,
+#   event id and the byte offset of the result file after the rows of the committed records. The journal is replaced
+#   atomically after the rows are fsynced, so that a restart can truncate the partially written rows and resume exactly.
+class CollaborationNetworkJournal:
+    suffix = '.checkpoint.json'
+
+    def __init__(self, save_path):
+        self.save_path = save_path
+        self.journal_path = save_path + CollaborationNetworkJournal.suffix
+
+    def load(self):
+        if not os.path.exists(self.journal_path):
+            return None
+        try:
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Failed to load the checkpoint journal {self.journal_path}: {e}! It will be ignored.")
+            return None
+
+    def commit(self, last_index=None, last_event_id=None, byte_offset=0, completed=False):
+        d_checkpoint = {
+            "save_path": self.save_path,
+            "last_index": int(last_index) if last_index is not None else None,
+            "last_event_id": int(last_event_id) if pd.notna(last_event_id) else None,
+            "byte_offset": int(byte_offset),
+            "completed": bool(completed),
+            "update_time": time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        temp_path = self.journal_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(d_checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.journal_path)
+        return d_checkpoint
+
+    def mark_completed(self):
+        d_checkpoint = self.load() or {}
+        return self.commit(d_checkpoint.get("last_index"), d_checkpoint.get("last_event_id"),
+                           d_checkpoint.get("byte_offset", 0), completed=True)
+
+    def remove(self):
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+    # Truncate the rows written after the last commit, returns the index of the record to resume from.
+    def recover(self):
+        d_checkpoint = self.load()
+        if d_checkpoint is None or d_checkpoint.get("completed"):
+            return None
+        if not os.path.exists(self.save_path) or os.path.getsize(self.save_path) < d_checkpoint["byte_offset"]:
+            print(f"The result file {self.save_path} is missing or shorter than the checkpoint journal records! "
+                  f"The journal will be ignored.")
+            return None
+        if os.path.getsize(self.save_path) > d_checkpoint["byte_offset"]:
+            with open(self.save_path, 'r+b') as f:
+                f.truncate(d_checkpoint["byte_offset"])
+        last_index = d_checkpoint.get("last_index")
+        return last_index + 1 if last_index is not None else 0
+
+
+# Buffered writer of the collaboration relations: keeps the save_path open and writes the accumulated rows every
+#   flush_rows rows or flush_interval seconds, instead of opening the file for each record as save_GitHub_Collaboration_Network.
+# The file is flushed and fsynced when closed, use it as a context manager to close it at the end of a repo or on exception.
+# The rows are appended to an existing save_path when add_mode_if_exists=True, otherwise the file is overwritten.
+# Set journal=CollaborationNetworkJournal(save_path) to commit the checkpoint passed to write() at each flush, the rows
+#   passed to write() should cover all the records up to the checkpoint. The initial checkpoint is committed when opened.
+class CollaborationNetworkWriter:
+    def __init__(self, save_path, add_mode_if_exists=False, make_dir_if_not_exist=True, columns=None,
+                 flush_rows=10000, flush_interval=30, journal=None, checkpoint=None):
+        self.save_path = save_path
+        self.columns = columns or columns_df_collaboration + columns_df_collaboration_extend_field
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.journal = journal
+        if make_dir_if_not_exist:
+            dir_path = os.path.dirname(save_path)
+            if dir_path and not os.path.exists(dir_path):
+                os.makedirs(dir_path)
+        append = add_mode_if_exists and os.path.exists(save_path)
+        self._file = open(save_path, mode='a' if append else 'w', encoding='utf-8', newline='')
+        if not append:
+            pd.DataFrame(columns=self.columns).to_csv(self._file, header=True, index=False, lineterminator='\n')
+        self._buffer = []
+        self._buffer_rows = 0
+        self._last_flush_time = time.time()
+        self._checkpoint = checkpoint  # the initial checkpoint before any record is written
+        self.rows_written = 0
+        if self.journal is not None:
+            self.flush(fsync=True)
+
+    # checkpoint: {"last_index": index, "last_event_id": event_id} of the last record whose rows are all in df_collaboration
+    def write(self, df_collaboration, checkpoint=None):
+        if len(df_collaboration):
+            self._buffer.append(df_collaboration)
+            self._buffer_rows += len(df_collaboration)
+        if checkpoint is not None:
+            self._checkpoint = checkpoint
+        if self._buffer_rows >= self.flush_rows or self.flush_due():
+            self.flush(fsync=self.journal is not None)
+
+    # whether the flush_interval has elapsed, the callers holding rows can hand them over to be flushed in time
+    def flush_due(self):
+        return time.time() - self._last_flush_time >= self.flush_interval
+
+    def flush(self, fsync=False):
+        if self._buffer_rows:
+            df_buffer = pd.concat(self._buffer, ignore_index=True)[self.columns]
+            df_buffer.to_csv(self._file, header=False, index=False, lineterminator='\n')
+            self.rows_written += self._buffer_rows
+            self._buffer = []
+            self._buffer_rows = 0
+        self._file.flush()
+        if fsync:
+            os.fsync(self._file.fileno())
+        if self.journal is not None and self._checkpoint is not None:
+            self.journal.commit(byte_offset=os.fstat(self._file.fileno()).st_size, **self._checkpoint)
+        self._last_flush_time = time.time()
+
+    def close(self):
+        if self._file.closed:
+            return
+        try:
+            self.flush(fsync=True)
+        finally:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
 if __name__ == '__main__':
     from etc import filePathConf
     from GH_CoRE.model.tst_case import df_tst
@@ -7,6 +7,7 @@
 # @File   : Relation_model.py
 
 import re
+from types import MappingProxyType
 
 import pandas as pd
 
@@ -38,6 +39,12 @@ class Relation:
     df_relation_type['relation_type'] = pd.DataFrame(df_ref_tuples_raw).apply(get_relation_type, axis=1)
     df_relation_type_unique = df_relation_type.drop_duplicates(subset='relation_label_repr', keep='first')
     df_relation_type_unique = df_relation_type_unique.reset_index().rename(columns={"index": "relation_label_id"})
+    # read-only lookup tables of df_relation_type_unique: {relation_label_id or relation_label_repr: record}
+    d_relation_type_by_id = MappingProxyType({rec["relation_label_id"]: rec for rec in df_relation_type_unique.to_dict("records")})
+    d_relation_type_by_repr = MappingProxyType({rec["relation_label_repr"]: rec for rec in df_relation_type_unique.to_dict("records")})
+    # the registries of the shared Relation instances, built after the class definition, see Relation.get
+    registry_by_id = MappingProxyType({})
+    registry_by_repr = MappingProxyType({})
 
     def __init__(self, relation_label_id=None, relation_label_repr=None):
         self.relation_label_id = None
@@ -64,14 +71,31 @@ class Relation:
             k_colname = f'relation_label_repr'
         else:
             raise ValueError("The variable by must be in ['id', 'repr']!")
-        rec_query = Relation.df_relation_type_unique[
-            Relation.df_relation_type_unique[k_colname] == getattr(self, k_colname, None)]
-        if len(rec_query):
-            self.relation_label_id = rec_query["relation_label_id"].values[0]
-            self.relation_type = rec_query["relation_type"].values[0]
-            self.relation_label_repr = rec_query["relation_label_repr"].values[0]
+        d_relation_type = Relation.d_relation_type_by_id if by == 'id' else Relation.d_relation_type_by_repr
+        try:
+            rec_query = d_relation_type.get(getattr(self, k_colname, None))
+        except TypeError:  # unhashable
+            rec_query = None
+        if rec_query:
+            self.relation_label_id = rec_query["relation_label_id"]
+            self.relation_type = rec_query["relation_type"]
+            self.relation_label_repr = rec_query["relation_label_repr"]
         return None
 
+    # Get the shared Relation instance in the registry, which should be treated as read-only. A new Relation is returned
+    #   when the relation label is not registered in Relation.df_relation_type_unique.
+    @staticmethod
+    def get(relation_label_id=None, relation_label_repr=None):
+        if relation_label_id is not None:
+            relation = Relation.registry_by_id.get(relation_label_id)
+            if relation is not None and (relation_label_repr is None or relation.relation_label_repr == relation_label_repr):
+                return relation
+        elif relation_label_repr is not None:
+            relation = Relation.registry_by_repr.get(relation_label_repr)
+            if relation is not None:
+                return relation
+        return Relation(relation_label_id=relation_label_id, relation_label_repr=relation_label_repr)
+
     def get_dict(self):
         return self.__dict__
 
@@ -79,6 +103,11 @@ class Relation:
         return self.relation_type + "::" + self.relation_label_repr + "#" + str(self.relation_label_id) or ''
 
 
+Relation.registry_by_id = MappingProxyType({k: Relation(relation_label_id=k) for k in Relation.d_relation_type_by_id.keys()})
+Relation.registry_by_repr = MappingProxyType({r.relation_label_repr: r for r in Relation.registry_by_id.values()})
+
+
 if __name__ == '__main__':
     print(Relation.df_relation_type_unique)
     print(Relation(relation_label_repr="Issue_OpenedBy_Actor").get_dict())
+    print(Relation.get(relation_label_repr="Issue_OpenedBy_Actor") is Relation.get(relation_label_id=0))
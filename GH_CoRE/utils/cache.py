@@ -5,15 +5,255 @@
 # @Time   : 2024/11/11 3:25
 # @Author : 'Lou Zehua'
 # @File   : cache.py
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import sys
+import threading
 import time
 import traceback
 
-from collections import deque
+from collections import OrderedDict
+from contextlib import contextmanager
 from functools import partial
 
 
+class _NaNKey:
+    # NaN与任何值都不相等，每个NaN特征值都生成一个新的_NaNKey实例
+    pass
+
+
+def _freeze(v):
+    # 将特征值转换为可哈希的key，相等的特征值得到相等的key；NaN与任何值都不相等，故每次生成唯一的key
+    if isinstance(v, dict):
+        return dict, tuple(sorted(((k, _freeze(x)) for k, x in v.items()), key=lambda kv: str(kv[0])))
+    if isinstance(v, (list, tuple)):
+        return type(v), tuple(_freeze(x) for x in v)
+    if isinstance(v, (set, frozenset)):
+        return frozenset, frozenset(_freeze(x) for x in v)
+    if isinstance(v, float) and v != v:
+        return _NaNKey()
+    hash(v)  # raise TypeError if unhashable, e.g. pandas.DataFrame
+    return v
+
+
+def _has_nan_key(feat_key):
+    if isinstance(feat_key, _NaNKey):
+        return True
+    if isinstance(feat_key, (tuple, frozenset)):
+        return any(_has_nan_key(v) for v in feat_key)
+    return False
+
+
+def _approx_sizeof(obj, depth=3):
+    # 近似估计对象占用的字节数，只递归depth层容器
+    try:
+        if isinstance(getattr(obj, "nbytes", None), int):  # e.g. request_api.CachedResponse, numpy.ndarray
+            return sys.getsizeof(obj) + obj.nbytes
+        if hasattr(obj, "memory_usage") and hasattr(obj, "shape"):  # pandas.DataFrame, pandas.Series
+            mem = obj.memory_usage(index=True, deep=False)
+            return int(mem.sum() if hasattr(mem, "sum") else mem)
+        if hasattr(obj, "content") and hasattr(obj, "status_code"):  # requests.Response
+            return sys.getsizeof(obj) + len(obj.content or b'') + 64 * len(getattr(obj, "headers", None) or {})
+        size = sys.getsizeof(obj)
+        if depth <= 0:
+            return size
+        if isinstance(obj, dict):
+            size += sum(_approx_sizeof(k, depth - 1) + _approx_sizeof(v, depth - 1) for k, v in obj.items())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            size += sum(_approx_sizeof(v, depth - 1) for v in obj)
+        elif hasattr(obj, "__dict__"):
+            size += _approx_sizeof(vars(obj), depth - 1)
+        return size
+    except Exception:
+        return sys.getsizeof(obj)
+
+
+# Disk-backed cache tier shared across runs and processes: a sqlite3 database in WAL mode.
+#   Each entry is keyed by (namespace, key) and stores a pickled record with its expiration time. The negative results
+#   (e.g. the 404 responses, the empty query results) expire after negative_ttl, the other ones after ttl (None for never).
+#   The expired entries and the least recently accessed ones beyond max_entries are removed by compact(), which runs
+#   automatically every compact_every writes.
+class PersistentCacheStore:
+    def __init__(self, path, ttl=None, negative_ttl=86400, max_entries=1000000, compact_every=10000, timeout=60):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.compact_every = compact_every
+        self.timeout = timeout
+        self._n_writes = 0
+        self._local = threading.local()  # sqlite3 connections can not be shared by threads or forked processes
+        dir_path = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        conn = self._get_conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS cache (namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB, "
+                     "negative INTEGER DEFAULT 0, expire_at REAL, accessed_at REAL, PRIMARY KEY (namespace, key))")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_accessed_at ON cache (accessed_at)")
+        conn.execute("CREATE TABLE IF NOT EXISTS claims (namespace TEXT NOT NULL, key TEXT NOT NULL, owner TEXT, "
+                     "expire_at REAL, PRIMARY KEY (namespace, key))")
+        conn.commit()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_local", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _get_conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def get_key(feat_keys, feat_key):
+        return hashlib.sha1(repr((tuple(feat_keys), feat_key)).encode('utf-8')).hexdigest()
+
+    # return: (found, record)
+    def get(self, namespace, key):
+        conn = self._get_conn()
+        now = time.time()
+        row = conn.execute("SELECT value, expire_at FROM cache WHERE namespace = ? AND key = ?",
+                           (namespace, key)).fetchone()
+        if row is None:
+            return False, None
+        value, expire_at = row
+        if expire_at is not None and expire_at <= now:
+            return False, None
+        try:
+            record = pickle.loads(value)
+        except Exception:
+            return False, None
+        try:
+            conn.execute("UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?", (now, namespace, key))
+            conn.commit()
+        except sqlite3.OperationalError:  # database is locked, skip the access time
+            pass
+        return True, record
+
+    def put(self, namespace, key, record, negative=False, ttl=None):
+        try:
+            value = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:  # the unpicklable records are only kept in memory
+            return False
+        ttl = ttl if ttl is not None else (self.negative_ttl if negative else self.ttl)
+        now = time.time()
+        expire_at = now + ttl if ttl is not None else None
+        conn = self._get_conn()
+        try:
+            conn.execute("INSERT OR REPLACE INTO cache (namespace, key, value, negative, expire_at, accessed_at) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", (namespace, key, value, int(bool(negative)), expire_at, now))
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            print(f"Failed to write the persistent cache {self.path}: {e}.")
+            return False
+        self._n_writes += 1
+        if self.compact_every and self._n_writes % self.compact_every == 0:
+            self.compact()
+        return True
+
+    def compact(self, vacuum=False):
+        conn = self._get_conn()
+        try:
+            conn.execute("DELETE FROM cache WHERE expire_at IS NOT NULL AND expire_at <= ?", (time.time(),))
+            if self.max_entries is not None:
+                n_entries = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+                if n_entries > self.max_entries:
+                    conn.execute("DELETE FROM cache WHERE rowid IN (SELECT rowid FROM cache ORDER BY accessed_at "
+                                 "LIMIT ?)", (n_entries - self.max_entries,))
+            conn.commit()
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            if vacuum:
+                conn.execute("VACUUM")
+        except sqlite3.OperationalError as e:
+            print(f"Failed to compact the persistent cache {self.path}: {e}.")
+        return
+
+    # Single-flight claims shared by processes: only the owner of an unexpired claim computes the entry, the others wait
+    #   for the entry to be put. The claim expires after lease seconds in case its owner is killed.
+    @staticmethod
+    def get_owner():
+        return f"{os.getpid()}:{threading.get_ident()}"
+
+    def claim(self, namespace, key, lease=300):
+        conn = self._get_conn()
+        now = time.time()
+        try:
+            conn.execute("DELETE FROM claims WHERE namespace = ? AND key = ? AND expire_at <= ?", (namespace, key, now))
+            cur = conn.execute("INSERT OR IGNORE INTO claims (namespace, key, owner, expire_at) VALUES (?, ?, ?, ?)",
+                               (namespace, key, self.get_owner(), now + lease))
+            conn.commit()
+        except sqlite3.OperationalError:  # database is locked, regard it as claimed by others
+            conn.rollback()
+            return False
+        return cur.rowcount == 1
+
+    def release(self, namespace, key):
+        conn = self._get_conn()
+        try:
+            conn.execute("DELETE FROM claims WHERE namespace = ? AND key = ? AND owner = ?",
+                         (namespace, key, self.get_owner()))
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            conn.rollback()
+            print(f"Failed to release the claim of {namespace}:{key}: {e}. It will expire after the lease.")
+        return
+
+    def __len__(self):
+        return self._get_conn().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+        return
+
+
+# The named caches for statistics, see get_cache_stats.
+cache_registry = {}
+
+
+def get_cache_stats(names=None):
+    names = names if names is not None else list(cache_registry.keys())
+    return {name: cache_registry[name].get_stats() for name in names if name in cache_registry}
+
+
+def format_cache_stats(d_cache_stats):
+    return '; '.join(f"{name}: {stats['entries']} entries, ~{stats['bytes'] / 1024 / 1024:.2f} MB, "
+                     f"hit rate {stats['hit_rate']:.2%} ({stats['hits']} hits, {stats['misses']} misses), "
+                     f"{stats['evictions']} evictions, {stats['time_saved']:.1f} s saved"
+                     for name, stats in d_cache_stats.items())
+
+
+# Append the statistics of the caches as a json line into the metrics file, with the extra fields, e.g. the repo_key.
+def save_cache_stats(metrics_path, d_cache_stats=None, **kwargs):
+    d_cache_stats = d_cache_stats if d_cache_stats is not None else get_cache_stats()
+    dir_path = os.path.dirname(os.path.abspath(metrics_path))
+    if not os.path.exists(dir_path):
+        os.makedirs(dir_path)
+    line = json.dumps(dict(kwargs, **{"time": time.strftime('%Y-%m-%d %H:%M:%S'), "pid": os.getpid(),
+                                      "caches": d_cache_stats}), default=str)
+    with open(metrics_path, 'a', encoding='utf-8') as f:
+        f.write(line + '\n')
+    return
+
+
 class QueryCache:
     match_func = lambda x, y: x == y
+    policies = ['lru', 'lfu', 'fifo', 'ttl']
+    miss_timing_max_size = 10000
 
     @staticmethod
     def d_match_func(params, record, feat_keys):
@@ -33,17 +273,284 @@ class QueryCache:
             is_matched = False
         return bool(is_matched)
 
-    def __init__(self, max_size=100, match_func=None):
-        self.cache = deque(maxlen=max_size)
+    @staticmethod
+    def get_feat_key(record, feat_keys):
+        record = dict(record)
+        return tuple(_freeze(record.get(k)) for k in feat_keys)
+
+    # max_size: the max number of records, None for no limit.
+    # policy: the eviction policy when the cache is full, in ['lru', 'lfu', 'fifo', 'ttl'].
+    #   'lru': evict the least recently used record; 'lfu': evict the least frequently used record, the least recently
+    #   added one first among the records used equally; 'fifo': evict the earliest added record; 'ttl': same as 'fifo',
+    #   with a required ttl.
+    # ttl: the seconds a record expires after it is added, None for never. It works with all the policies.
+    # The records are indexed by the hashable key of the 'feat_keys' when the match_func is a partial of d_match_func,
+    #   otherwise the records are scanned one by one with the match_func.
+    # name: register the cache by name into cache_registry to report its statistics, see get_stats.
+    # max_bytes: the max approximate bytes of the records, None for no limit. The records are evicted by the policy until
+    #   both max_size and max_bytes are satisfied, at least one record is kept.
+    def __init__(self, max_size=100, match_func=None, policy='lru', ttl=None, name=None, max_bytes=None):
+        if policy not in self.__class__.policies:
+            raise ValueError(f"policy must be in {self.__class__.policies}.")
+        if policy == 'ttl' and ttl is None:
+            raise ValueError("ttl must be set when policy='ttl'.")
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.ttl = ttl
         self.match_func = match_func or self.__class__.match_func
+        self._lock = threading.RLock()  # the cache may be shared by the threads resolving links concurrently
+        self.persistent_store = None
+        self.persistent_namespace = None
+        self.is_negative = None
+        self.persistent_ttl = None
+        self._flights = {}  # {(feat_keys, feat_key): threading.Event}, the in-process single-flight claims
+        self.clear()
+        self.reset_stats()
+        self.name = name
+        if name is not None:
+            cache_registry[name] = self
+        return
+
+    # hits: the records found in memory or in the persistent store (persistent_hits); misses: the records not found;
+    # evictions/expirations: the records removed for the max_size/ttl; bytes: the approximate size of the records;
+    # time_saved: the sum of the time taken to compute the hit records, measured from their misses to their addition.
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {"hits": 0, "misses": 0, "persistent_hits": 0, "evictions": 0, "expirations": 0,
+                          "time_saved": 0.0}
+            self._miss_at = OrderedDict()  # {feat_key: timestamp of the last miss}
         return
 
-    def add_record(self, record, skip_dup=True):
-        if skip_dup and record in self.cache:
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            n_lookups = stats["hits"] + stats["misses"]
+            stats.update({"name": self.name, "policy": self.policy, "max_size": self.max_size,
+                          "max_bytes": self.max_bytes, "entries": len(self._entries), "bytes": self._bytes,
+                          "hit_rate": stats["hits"] / n_lookups if n_lookups else 0.0})
+        return stats
+
+    # Use a PersistentCacheStore as the disk tier of this cache: the records missed in memory are looked up in the
+    #   store by the hashable key of the feat_keys, and the added records are written through to it.
+    # is_negative: a function of a record, the negative records expire after the negative_ttl of the store.
+    # ttl: the seconds the other records of this cache expire after in the store, None for the ttl of the store.
+    def set_persistent_store(self, persistent_store, namespace, is_negative=None, ttl=None):
+        self.persistent_store = persistent_store
+        self.persistent_namespace = namespace
+        self.is_negative = is_negative
+        self.persistent_ttl = ttl
+        return
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()  # {entry_id: record}, ordered by the eviction priority except for 'lfu'
+            self._expire_at = {}  # {entry_id: timestamp}
+            self._freq = {}  # 'lfu': {entry_id: use count}
+            self._freq_entries = {}  # 'lfu': {use count: OrderedDict{entry_id: None}}
+            self._min_freq = 0
+            self._indexes = {}  # {feat_keys: {feat_key: entry_id}}, built lazily for each feat_keys in use
+            # {feat_keys: {feat_key: OrderedDict{entry_id: None}}}, the later records of the indexed keys in the added
+            #   order, one of them takes the place of the indexed record when it is removed
+            self._shadowed = {}
+            self._unindexed = {}  # {feat_keys: set of entry_id}, the records with unhashable features
+            self._entry_keys = {}  # {entry_id: {feat_keys: feat_key}}
+            self._entry_bytes = {}  # {entry_id: approximate size}
+            self._entry_cost = {}  # {entry_id: seconds taken to compute the record}
+            self._bytes = 0
+            self._next_id = 0
+        return
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_lock", None)
+        state.pop("_flights", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+        self._flights = {}
+
+    def _get_feat_keys(self, match_func=None):
+        match_func = match_func or self.match_func
+        if isinstance(match_func, partial) and match_func.func is QueryCache.d_match_func and not match_func.args:
+            feat_keys = match_func.keywords.get("feat_keys")
+            if feat_keys:
+                return tuple(feat_keys)
+        return None
+
+    def _get_index(self, feat_keys):
+        index = self._indexes.get(feat_keys)
+        if index is None:
+            index = {}
+            self._indexes[feat_keys] = index
+            self._unindexed[feat_keys] = set()
+            self._shadowed[feat_keys] = {}
+            for entry_id, record in self._entries.items():
+                self._index_entry(entry_id, record, feat_keys)
+        return index
+
+    def _index_entry(self, entry_id, record, feat_keys):
+        try:
+            feat_key = self.get_feat_key(record, feat_keys)
+        except (TypeError, ValueError):
+            self._unindexed[feat_keys].add(entry_id)
             return
-        self.cache.append(record)
+        index = self._indexes[feat_keys]
+        if feat_key not in index:  # keep the earlier record as the linear scan does
+            index[feat_key] = entry_id
+        else:
+            self._shadowed[feat_keys].setdefault(feat_key, OrderedDict())[entry_id] = None
+        self._entry_keys.setdefault(entry_id, {})[feat_keys] = feat_key
+
+    def _remove_entry(self, entry_id):
+        self._entries.pop(entry_id, None)
+        self._expire_at.pop(entry_id, None)
+        self._bytes -= self._entry_bytes.pop(entry_id, 0)
+        self._entry_cost.pop(entry_id, None)
+        freq = self._freq.pop(entry_id, None)
+        if freq is not None:
+            self._freq_entries[freq].pop(entry_id, None)
+            if not self._freq_entries[freq]:
+                del self._freq_entries[freq]
+        for feat_keys, feat_key in self._entry_keys.pop(entry_id, {}).items():
+            index = self._indexes[feat_keys]
+            shadowed = self._shadowed[feat_keys].get(feat_key)
+            if index.get(feat_key) == entry_id:
+                if shadowed:  # the earliest of the later records with the same key, as the linear scan finds
+                    index[feat_key] = shadowed.popitem(last=False)[0]
+                else:
+                    del index[feat_key]
+            elif shadowed is not None:
+                shadowed.pop(entry_id, None)
+            if shadowed is not None and not shadowed:
+                del self._shadowed[feat_keys][feat_key]
+        for unindexed in self._unindexed.values():
+            unindexed.discard(entry_id)
+
+    def _is_expired(self, entry_id):
+        expire_at = self._expire_at.get(entry_id)
+        if expire_at is not None and expire_at <= time.time():
+            self._remove_entry(entry_id)
+            self.stats["expirations"] += 1
+            return True
+        return False
+
+    def _touch(self, entry_id):
+        if self.policy == 'lru':
+            self._entries.move_to_end(entry_id)
+        elif self.policy == 'lfu':
+            freq = self._freq[entry_id]
+            self._freq_entries[freq].pop(entry_id)
+            if not self._freq_entries[freq]:
+                del self._freq_entries[freq]
+                if self._min_freq == freq:
+                    self._min_freq = freq + 1
+            self._freq[entry_id] = freq + 1
+            self._freq_entries.setdefault(freq + 1, OrderedDict())[entry_id] = None
+
+    def _is_full(self):
+        if self.max_size is not None and len(self._entries) > max(self.max_size, 0):
+            return True
+        return self.max_bytes is not None and self._bytes > self.max_bytes and len(self._entries) > 1
+
+    def _evict(self):
+        while self._is_full():
+            if self.policy == 'lfu':
+                if self._min_freq not in self._freq_entries:
+                    self._min_freq = min(self._freq_entries.keys())
+                entry_id = next(iter(self._freq_entries[self._min_freq]))
+            else:
+                entry_id = next(iter(self._entries))
+            self._remove_entry(entry_id)
+            self.stats["evictions"] += 1
+
+    def _find_entry(self, query_feature, match_func=None, load_persistent=False):
+        feat_keys = self._get_feat_keys(match_func)
+        if feat_keys is not None:
+            try:
+                feat_key = self.get_feat_key(query_feature, feat_keys)
+            except (TypeError, ValueError):
+                feat_key = None
+            if feat_key is not None:
+                index = self._get_index(feat_keys)
+                entry_id = index.get(feat_key)
+                while entry_id is not None and self._is_expired(entry_id):
+                    entry_id = index.get(feat_key)  # a later record with the same key may take its place
+                if entry_id is not None:
+                    return entry_id
+                if load_persistent and self.persistent_store is not None and not _has_nan_key(feat_key):
+                    found, record = self.persistent_store.get(self.persistent_namespace,
+                                                              PersistentCacheStore.get_key(feat_keys, feat_key))
+                    if found:
+                        self.stats["persistent_hits"] += 1
+                        return self._add_entry(record)
+                candidate_entry_ids = sorted(self._unindexed[feat_keys])
+            else:
+                candidate_entry_ids = list(self._entries.keys())
+        else:
+            candidate_entry_ids = list(self._entries.keys())
+        match_func = match_func or self.match_func
+        for entry_id in candidate_entry_ids:
+            if entry_id in self._entries and not self._is_expired(entry_id):
+                if match_func(query_feature, self._entries[entry_id]):
+                    return entry_id
+        return None
+
+    # persist: write the record through to the persistent store if any, set persist=False for the records loaded from
+    #   elsewhere, e.g. warming the cache.
+    def add_record(self, record, skip_dup=True, persist=True):
+        with self._lock:
+            if skip_dup:
+                feat_keys = self._get_feat_keys()
+                if feat_keys is not None:
+                    entry_id = self._find_entry(record)
+                    if entry_id is not None and self._entries[entry_id] == record:
+                        return
+                elif record in self._entries.values():
+                    return
+            entry_id = self._add_entry(record)
+            if persist and self.persistent_store is not None:
+                self._persist_entry(entry_id)
+            self._evict()
         return
 
+    def _add_entry(self, record):
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = record
+        if self.ttl is not None:
+            self._expire_at[entry_id] = time.time() + self.ttl
+        if self.policy == 'lfu':
+            self._freq[entry_id] = 1
+            self._freq_entries.setdefault(1, OrderedDict())[entry_id] = None
+            self._min_freq = 1
+        for feat_keys in self._indexes.keys():
+            self._index_entry(entry_id, record, feat_keys)
+        self._entry_bytes[entry_id] = _approx_sizeof(record)
+        self._bytes += self._entry_bytes[entry_id]
+        feat_key = self._entry_keys.get(entry_id, {}).get(self._get_feat_keys())
+        if feat_key is not None and feat_key in self._miss_at:
+            self._entry_cost[entry_id] = time.time() - self._miss_at.pop(feat_key)
+        return entry_id
+
+    def _persist_entry(self, entry_id):
+        feat_keys = self._get_feat_keys()
+        if feat_keys is None:
+            return
+        self._get_index(feat_keys)
+        feat_key = self._entry_keys.get(entry_id, {}).get(feat_keys)
+        if feat_key is None or _has_nan_key(feat_key):
+            return
+        record = self._entries[entry_id]
+        negative = bool(self.is_negative(record)) if self.is_negative is not None else False
+        self.persistent_store.put(self.persistent_namespace, PersistentCacheStore.get_key(feat_keys, feat_key), record,
+                                  negative=negative, ttl=None if negative else self.persistent_ttl)
+
     def add_records(self, records, **kwargs):
         try:
             records = list(records)
@@ -55,17 +562,85 @@ class QueryCache:
         return
 
     def get_recent_records(self):
-        return self.cache
+        with self._lock:
+            return list(self._entries.values())
 
-    def find_record_in_cache(self, query_feature, match_func=None):
+    def find_record_in_cache(self, query_feature, match_func=None, count_stats=True):
         self.match_func = match_func or self.match_func
         res_record = None
-        for cache_record in self.cache:
-            if self.match_func(query_feature, cache_record):
-                res_record = cache_record
-                break
+        with self._lock:
+            entry_id = self._find_entry(query_feature, load_persistent=True)
+            if entry_id is not None:
+                self._touch(entry_id)
+                res_record = self._entries[entry_id]
+                if count_stats:
+                    self.stats["hits"] += 1
+                    self.stats["time_saved"] += self._entry_cost.get(entry_id, 0.0)
+                self._evict()
+            elif count_stats:
+                self.stats["misses"] += 1
+                feat_keys = self._get_feat_keys()
+                if feat_keys is not None:
+                    try:
+                        self._miss_at.setdefault(self.get_feat_key(query_feature, feat_keys), time.time())
+                    except (TypeError, ValueError):
+                        pass
+                    while len(self._miss_at) > self.__class__.miss_timing_max_size:
+                        self._miss_at.popitem(last=False)
         return res_record
 
+    # Single-flight lookup: yield the cached record, or None when the caller is the only one to compute it, the others
+    #   querying the same feature wait until it is added. The threads are coordinated in process, and the processes
+    #   sharing the same persistent store are coordinated by its claims.
+    # Usage:
+    #   with cache.single_flight(feature) as record_info_cached:
+    #       if not record_info_cached:
+    #           cache.add_record(dict(**feature, **{"result": compute(feature)}))
+    @contextmanager
+    def single_flight(self, query_feature, lease=300, poll_interval=0.05):
+        record = self.find_record_in_cache(query_feature)
+        feat_keys = self._get_feat_keys()
+        flight_key = None
+        if not record and feat_keys is not None:
+            try:
+                flight_key = (feat_keys, self.get_feat_key(query_feature, feat_keys))
+                hash(flight_key)
+            except (TypeError, ValueError):
+                flight_key = None
+            if flight_key is not None and _has_nan_key(flight_key[1]):
+                flight_key = None
+        claimed_local = False
+        claimed_store = False
+        persistent_store = self.persistent_store
+        try:
+            while flight_key is not None and not record:
+                with self._lock:
+                    event = self._flights.get(flight_key)
+                    if event is None:
+                        self._flights[flight_key] = threading.Event()
+                        claimed_local = True
+                if claimed_local:
+                    break
+                event.wait()
+                record = self.find_record_in_cache(query_feature, count_stats=False)
+            if claimed_local and persistent_store is not None:
+                store_key = PersistentCacheStore.get_key(*flight_key)
+                while not record:
+                    if persistent_store.claim(self.persistent_namespace, store_key, lease=lease):
+                        claimed_store = True
+                        break
+                    time.sleep(poll_interval)
+                    record = self.find_record_in_cache(query_feature, count_stats=False)
+            if claimed_local and not record:  # added by the owner before it released the claim
+                record = self.find_record_in_cache(query_feature, count_stats=False)
+            yield record
+        finally:
+            if claimed_store:
+                persistent_store.release(self.persistent_namespace, PersistentCacheStore.get_key(*flight_key))
+            if claimed_local:
+                with self._lock:
+                    self._flights.pop(flight_key).set()
+
 
 if __name__ == '__main__':
     # 使用示例
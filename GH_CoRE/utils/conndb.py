@@ -8,12 +8,18 @@
 
 from __future__ import annotations
 
+import os
+import socket
 import sys
+import threading
 import time
 import traceback
+from collections import deque
+from contextlib import contextmanager
 
 from sshtunnel import SSHTunnelForwarder
 from clickhouse_driver import Client
+from clickhouse_driver import errors as ch_errors
 
 
 class AuthConfig:
@@ -85,6 +91,146 @@ class AuthConfig:
     default_auth_settings_dict = auth_settings_dicts[DEFAULT_INTMED_MODE]
 
 
+# A process-wide pool of ClickHouse clients shared by all the ConnDB instances of the same intmed_mode. A clickhouse_driver
+#   Client can only be used by one thread at a time, each query borrows an idle client of the pool and keeps its connection
+#   alive for the next query. In the I_AUTH_SETTINGS_ALIYUN_INTERMEDIATE_HOSTS mode the clients connect through one
+#   long-lived SSH tunnel, which is restarted when it is down.
+# pool_size: the max number of clients, the queries wait for an idle client when all of them are in use.
+# health_check_interval: ping the connection of a client idle for longer than this before it is reused, in seconds.
+class ClickHouseClientPool:
+    def __init__(self, conndb, pool_size=8, health_check_interval=60):
+        self.conndb = conndb
+        self.pool_size = pool_size
+        self.health_check_interval = health_check_interval
+        self.pid = os.getpid()
+        self._idle = deque()  # [(client, generation, last_used)]
+        self._n_clients = 0
+        self._generation = 0  # the clients of an older generation were connected to a closed tunnel
+        self._tunnel = None
+        self._cond = threading.Condition()
+
+    def _start_tunnel(self):
+        conndb = self.conndb
+        local_ports = [conndb.SERVER_PORT_LOCALHOST, 0]  # the configured port, or any available port if it is in use
+        for i, local_port in enumerate(local_ports):
+            tunnel = SSHTunnelForwarder(
+                (conndb.SERVER_IP_INTMED_1, conndb.SERVER_PORT_INTMED_1),
+                ssh_username=conndb.USERNAME_INTMED_1,
+                ssh_password=conndb.PASSWORD_INTMED_1,
+                remote_bind_address=(conndb.SERVER_IP_TARGET, conndb.SERVER_PORT_TARGET),
+                local_bind_address=('0.0.0.0', local_port))
+            try:
+                tunnel.start()
+            except BaseException:
+                if i == len(local_ports) - 1:
+                    raise
+                continue
+            return tunnel
+
+    def _ensure_tunnel(self):
+        if self.conndb.intmed_mode != self.conndb.auth_config.I_AUTH_SETTINGS_ALIYUN_INTERMEDIATE_HOSTS:
+            return None
+        if self._tunnel is None or not self._tunnel.is_active:
+            if self._tunnel is not None:
+                print("The SSH tunnel is down, restart it.")
+                self.close_tunnel()
+            self._tunnel = self._start_tunnel()
+            self._generation += 1
+        return self._tunnel
+
+    def _new_client(self):
+        conndb = self.conndb
+        auth_config = conndb.auth_config
+        if conndb.intmed_mode == auth_config.I_AUTH_SETTINGS_LOCAL_HOSTS:
+            host, port = conndb.SERVER_IP_LOCALHOST, conndb.SERVER_PORT_LOCALHOST
+        elif conndb.intmed_mode == auth_config.I_AUTH_SETTINGS_ALIYUN_HOSTS:
+            host, port = conndb.SERVER_IP_TARGET, conndb.SERVER_PORT_TARGET
+        elif conndb.intmed_mode == auth_config.I_AUTH_SETTINGS_ALIYUN_INTERMEDIATE_HOSTS:
+            host, port = conndb.SERVER_IP_LOCALHOST, self._ensure_tunnel().local_bind_port
+        else:
+            raise ValueError(f"The intmed_mode is expected in {list(auth_config.auth_settings_dicts.keys())}! "
+                             f"Got intmed_mode={conndb.intmed_mode}!")
+        return Client(host=host, port=port, user=conndb.DBMS_USERNAME, password=conndb.DBMS_PASSWORD,
+                      database=conndb.USE_DATABASE, send_receive_timeout=600)
+
+    def _is_healthy(self, client, generation, last_used):
+        if generation != self._generation:
+            return False
+        connection = client.connection
+        if connection.connected and time.time() - last_used > self.health_check_interval:
+            try:
+                return bool(connection.ping())
+            except BaseException:
+                return False
+        return True
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                self._ensure_tunnel()
+                while self._idle:
+                    client, generation, last_used = self._idle.pop()  # the most recently used client first
+                    if self._is_healthy(client, generation, last_used):
+                        return client
+                    self._disconnect(client)
+                if self._n_clients < self.pool_size:
+                    client = self._new_client()
+                    client._pool_generation = self._generation
+                    self._n_clients += 1
+                    return client
+                self._cond.wait()
+
+    # discard: disconnect the client after a connection error, a new client will be created instead
+    def release(self, client, discard=False):
+        with self._cond:
+            generation = getattr(client, "_pool_generation", self._generation)
+            if discard or generation != self._generation or self._n_clients > self.pool_size:
+                self._disconnect(client)
+            else:
+                self._idle.append((client, generation, time.time()))
+            self._cond.notify()
+
+    def _disconnect(self, client):
+        self._n_clients -= 1
+        try:
+            client.disconnect()
+        except BaseException:
+            pass
+
+    @contextmanager
+    def connection(self):
+        client = self.acquire()
+        discard = False
+        try:
+            yield client
+        except ch_errors.ServerException:  # the query is rejected by the server, the connection is still usable
+            raise
+        except BaseException:  # the connection may be broken or left with a partially read response
+            discard = True
+            raise
+        finally:
+            self.release(client, discard=discard)
+
+    def close_tunnel(self):
+        if self._tunnel is not None:
+            try:
+                self._tunnel.stop()
+            except BaseException:
+                pass
+            self._tunnel = None
+
+    def close(self):
+        with self._cond:
+            while self._idle:
+                self._disconnect(self._idle.pop()[0])
+            self.close_tunnel()
+            self._generation += 1
+
+
+_client_pools = {}  # {(pid, intmed_mode): ClickHouseClientPool}
+_client_pools_lock = threading.Lock()
+
+
 class ConnDB:
     try:
         from etc.authConf import AuthConfig as LocAuthConfig
@@ -100,9 +246,20 @@ class ConnDB:
     client = None
     show_time_cost = False
     intmed_mode = auth_config.DEFAULT_INTMED_MODE
-
-    def __init__(self, sql: str | None = None, intmed_mode: int | None = None, auto_update_columns: bool | None = None):
+    pool_size = 8  # the max number of pooled clients of each intmed_mode in a process, see ClickHouseClientPool
+    health_check_interval = 60
+    retry = 2  # reconnect and retry the query after a connection error
+    # only the socket-level errors, the other OSErrors (e.g. writing the local files in run_with_client) are raised
+    reconnect_errors = (ch_errors.NetworkError, ch_errors.SocketTimeoutError, EOFError, ConnectionError, socket.timeout)
+    exit_on_error = True  # exit the process if the query fails, set False to raise the exception to the caller
+
+    def __init__(self, sql: str | None = None, intmed_mode: int | None = None, auto_update_columns: bool | None = None,
+                 pool_size: int | None = None, exit_on_error: bool | None = None):
         self.sql = sql
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if exit_on_error is not None:
+            self.exit_on_error = exit_on_error
 
         if intmed_mode is None:
             self.intmed_mode = ConnDB.intmed_mode
@@ -130,36 +287,38 @@ class ConnDB:
         if auto_update_columns is not None:
             self.auto_update_columns = auto_update_columns
 
+    # The pool of the intmed_mode in the current process, a forked process creates its own pool.
+    def get_client_pool(self):
+        key = (os.getpid(), self.intmed_mode)
+        with _client_pools_lock:
+            pool = _client_pools.get(key)
+            if pool is None:
+                pool = ClickHouseClientPool(self, pool_size=self.pool_size,
+                                            health_check_interval=self.health_check_interval)
+                _client_pools[key] = pool
+            pool.pool_size = self.pool_size
+        return pool
+
+    # Run func(client) with a pooled client, reconnect and retry after a connection error.
+    def run_with_client(self, func, retry=None):
+        retry = self.retry if retry is None else retry
+        pool = self.get_client_pool()
+        while True:
+            try:
+                with pool.connection() as client:
+                    self.client = client
+                    return func(client)
+            except self.reconnect_errors as e:
+                if retry <= 0:
+                    raise
+                retry -= 1
+                print(f"Reconnect to the database after a connection error: {e.__class__.__name__}: {e}.")
+            finally:
+                self.client = None
+
     def query(self, *args, **kwargs):
         try:
-            if self.intmed_mode == self.auth_config.I_AUTH_SETTINGS_LOCAL_HOSTS:
-                self.client = Client(host=self.SERVER_IP_LOCALHOST, port=self.SERVER_PORT_LOCALHOST,
-                                     user=self.DBMS_USERNAME,
-                                     password=self.DBMS_PASSWORD,
-                                     database=self.USE_DATABASE,
-                                     send_receive_timeout=600)
-            elif self.intmed_mode == self.auth_config.I_AUTH_SETTINGS_ALIYUN_HOSTS:
-                self.client = Client(host=self.SERVER_IP_TARGET, port=self.SERVER_PORT_TARGET,
-                                     user=self.DBMS_USERNAME,
-                                     password=self.DBMS_PASSWORD,
-                                     database=self.USE_DATABASE,
-                                     send_receive_timeout=600)
-            elif self.intmed_mode == self.auth_config.I_AUTH_SETTINGS_ALIYUN_INTERMEDIATE_HOSTS:
-                with SSHTunnelForwarder(
-                        (self.SERVER_IP_INTMED_1, self.SERVER_PORT_INTMED_1),
-                        ssh_username=self.USERNAME_INTMED_1,
-                        ssh_password=self.PASSWORD_INTMED_1,
-                        remote_bind_address=(self.SERVER_IP_TARGET, self.SERVER_PORT_TARGET),
-                        local_bind_address=('0.0.0.0', self.SERVER_PORT_LOCALHOST)) as tunnel:
-                    self.client = Client(host=self.SERVER_IP_LOCALHOST, port=tunnel.local_bind_port,
-                                         user=self.DBMS_USERNAME,
-                                         password=self.DBMS_PASSWORD,
-                                         database=self.USE_DATABASE,
-                                         send_receive_timeout=600)
-            else:
-                raise ValueError(f"The intmed_mode is expected in {list(self.auth_config.auth_settings_dicts.keys())}! "
-                                 f"Got intmed_mode={self.intmed_mode}!")
-            self.rs = self.client.query_dataframe(*args, **kwargs)
+            self.rs = self.run_with_client(lambda client: client.query_dataframe(*args, **kwargs))
             if self.auto_update_columns:
                 self.columns = self.rs.columns
             else:
@@ -168,7 +327,9 @@ class ConnDB:
             sql_log = self.sql[:500] + ("..." if self.sql[500:] else "")
             print("DB Exception happened while querying sql: \n\t{}\n".format(sql_log))
             print('Check the connection settings.\n' + traceback.format_exc())
-            sys.exit()
+            if self.exit_on_error:
+                sys.exit()
+            raise
         if not self.df_format:
             self.rs = self.rs.apply(lambda x: tuple(x), axis=1).values.tolist()
         return self.rs
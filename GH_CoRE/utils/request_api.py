@@ -6,16 +6,41 @@
 # @Author : 'Lou Zehua'
 # @File   : request_api.py 
 
+import json
+import os
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
 import requests
 import time
+from requests.adapters import HTTPAdapter
 
-from GH_CoRE.utils.cache import QueryCache
+from GH_CoRE.utils.cache import PersistentCacheStore, QueryCache
 
 GITHUB_TOKENS = ['GITHUB_TOKEN_1', 'GITHUB_TOKEN_2']
 
+SESSION_POOL_MAXSIZE = 10  # the max keep-alive connections per host of each session
+REQUEST_TIMEOUT = (10, 60)  # (connect timeout, read timeout) in seconds, None to wait forever
+
+_session_local = threading.local()
+
+
+# Get the requests.Session of the current thread, the keep-alive connections are pooled and reused by all the requests
+#   of the thread, e.g. to api.github.com. A new session is created in a forked process.
+def get_session(pool_maxsize=None):
+    session = getattr(_session_local, "session", None)
+    if session is None or getattr(_session_local, "pid", None) != os.getpid():
+        pool_maxsize = pool_maxsize or SESSION_POOL_MAXSIZE
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _session_local.session = session
+        _session_local.pid = os.getpid()
+    return session
+
 
 class RequestAPI:
     base_url = ''
@@ -27,6 +52,7 @@ class RequestAPI:
     password = ''
     query = None  # for post json
     default_method = 'GET'
+    timeout = REQUEST_TIMEOUT
 
     def __init__(self, auth_type='token', token=None, headers=None, username=None, password=None, query=None,
                  method=None, **kwargs):
@@ -36,7 +62,7 @@ class RequestAPI:
         self.method = method or self.__class__.default_method
         if self.auth_type == 'token':
             self.token = token or self.__class__.token
-            self.headers = headers or self.__class__.headers
+            self.headers = dict(headers or self.__class__.headers)  # the token of each instance is set in its own headers
         elif self.auth_type == 'password':
             self.username = username or self.__class__.username
             self.password = password or self.__class__.password
@@ -51,10 +77,11 @@ class RequestAPI:
 
     def request_get(self, url=None):
         url = url or self.base_url
+        session = get_session()
         if self.auth_type == 'token':
-            response = requests.get(url, headers=self.headers)
+            response = session.get(url, headers=self.headers, timeout=self.timeout)
         elif self.auth_type == 'password':
-            response = requests.get(url, auth=self.auth)
+            response = session.get(url, auth=self.auth, timeout=self.timeout)
         else:
             raise ValueError("auth_type must be in ['token', 'password'].")
         return response
@@ -63,11 +90,13 @@ class RequestAPI:
         self.base_url = base_url or self.base_url
         self.query = query or self.query
         variables = kwargs.pop("variables") if "variables" in kwargs.keys() else None
+        kwargs["timeout"] = kwargs.get("timeout", self.timeout)
+        session = get_session()
         if self.auth_type == 'token':
             # print(base_url, self.query, self.headers)
-            response = requests.post(self.base_url, json={'query': self.query, "variables": variables}, headers=self.headers, **kwargs)
+            response = session.post(self.base_url, json={'query': self.query, "variables": variables}, headers=self.headers, **kwargs)
         elif self.auth_type == 'password':
-            response = requests.post(self.base_url, json={'query': self.query, "variables": variables}, auth=self.auth, **kwargs)
+            response = session.post(self.base_url, json={'query': self.query, "variables": variables}, auth=self.auth, **kwargs)
         else:
             raise ValueError("auth_type must be in ['token', 'password'].")
         return response
@@ -92,8 +121,10 @@ class RequestAPI:
             except requests.exceptions.ConnectionError as e:
                 print(f"Crawling speed is too fast, take a break {default_break} sec.")
                 time.sleep(default_break)
+            except requests.exceptions.Timeout as e:
+                print(f"Request timed out: {url}.")
             else:
-                if response.status_code == 200:  # Connected, skip retry
+                if response.status_code in [200, 304]:  # Connected, skip retry; 304: Not Modified for conditional requests
                     pass
                 else:  # Connected, skip retry
                     print(f"Error fetching {url}: {response.status_code}.")
@@ -103,9 +134,118 @@ class RequestAPI:
         return None
 
 
+def trim_json(data, keys):
+    # 只保留keys中的字段，嵌套的dict与list同样处理
+    if isinstance(data, dict):
+        return {k: trim_json(v, keys) for k, v in data.items() if k in keys}
+    elif isinstance(data, list):
+        return [trim_json(v, keys) for v in data]
+    return data
+
+
+# A compact response kept in the caches instead of requests.Response: the status code, the url, the rate limit headers
+#   and the parsed json trimmed to the fields the callers need. It has the same json(), status_code, ok and __bool__.
+class CachedResponse:
+    keep_headers = ['X-RateLimit-Remaining', 'X-RateLimit-Reset', 'X-Ratelimit-Resource', 'Retry-After', 'ETag',
+                    'Last-Modified']
+
+    def __init__(self, status_code, url=None, json_data=None, headers=None, json_error=False):
+        self.status_code = status_code
+        self.url = url
+        self._json_data = json_data
+        self._json_error = json_error
+        self.headers = headers or {}
+        self.nbytes = len(self.content) + 64 * len(self.headers) + 128
+
+    @classmethod
+    def from_response(cls, response, json_keys=None):
+        if response is None or isinstance(response, cls):
+            return response
+        try:
+            json_data = response.json()
+            json_error = False
+        except ValueError:
+            json_data = None
+            json_error = True
+        if json_keys is not None:
+            json_data = trim_json(json_data, json_keys)
+        headers = {k: response.headers[k] for k in cls.keep_headers if k in response.headers}
+        return cls(response.status_code, url=response.url, json_data=json_data, headers=headers, json_error=json_error)
+
+    def json(self):
+        if self._json_error:
+            raise requests.exceptions.JSONDecodeError("Expecting value", "", 0)
+        return self._json_data
+
+    @property
+    def content(self):
+        return json.dumps(self._json_data).encode('utf-8') if not self._json_error else b''
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def __bool__(self):
+        return self.ok
+
+    def __repr__(self):
+        return f"<CachedResponse [{self.status_code}]>"
+
+
+_rate_limit_local = threading.local()
+
+
+# Raised by GitHubTokenPool.get_GithubToken in a RateLimitDeferral instead of waiting for the quota reset.
+class RateLimitDeferred(Exception):
+    def __init__(self, resource=None, reset=None):
+        self.resource = resource
+        self.reset = reset
+        super().__init__(f"The {resource} rate limit of all the tokens is exceeded until {reset}.")
+
+
+# In the context, the GitHub requests of the current thread raise RateLimitDeferred rather than sleep until the quota is
+#   reset, so that the caller can put off the work depending on the API. The resource and reset of the deferral are
+#   recorded even if the exception is caught in the callee, check them with `deferred`. The exception is suppressed at the
+#   end of the context.
+class RateLimitDeferral:
+    def __init__(self):
+        self.deferred = False
+        self.resource = None
+        self.reset = None
+        self._prev = None
+
+    def defer(self, resource=None, reset=None):
+        if not self.deferred:
+            self.deferred = True
+            self.resource = resource
+            self.reset = reset
+
+    def __enter__(self):
+        self._prev = getattr(_rate_limit_local, "deferral", None)
+        _rate_limit_local.deferral = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _rate_limit_local.deferral = self._prev
+        suppress = exc_type is not None and issubclass(exc_type, RateLimitDeferred)
+        if suppress:
+            self.defer(exc_val.resource, exc_val.reset)
+        if self.deferred and self._prev is not None:  # the outer context is deferred as well
+            self._prev.defer(self.resource, self.reset)
+        return suppress
+
+
 class GitHubTokenPool:
+    # The quota of each resource of a token before its rate limit headers are known, the buckets are refilled to the
+    #   limit when the quota window is reset.
+    #   see https://docs.github.com/en/rest/using-the-rest-api/rate-limits-for-the-rest-api?apiVersion=2022-11-28
+    resource_limits = {'core': 5000, 'search': 30, 'code_search': 10, 'graphql': 5000}
 
-    def __init__(self, github_tokens=None):
+    def __init__(self, github_tokens=None, reserve=0):
         self.github_tokens = github_tokens
         if self.github_tokens is None:
             try:
@@ -116,6 +256,11 @@ class GitHubTokenPool:
         self.tokenState_list = self.init_tokenState_list(strict=False)  # strict=False for pass GitHub build test
         self.minTime_tokenState = self.__class__.init_empty_tokenState()
         self.ip_limit_resource = ['search']
+        self.reserve = reserve  # the quota left unused in each bucket
+        # token buckets: {resource: {token: tokenState}}, the in-flight requests are reserved from the remaining quota
+        #   so that the concurrent requests never exceed the rate limit of a token.
+        self.token_buckets = {}
+        self._cond = threading.Condition(threading.RLock())
 
     @staticmethod
     def init_empty_tokenState(reset=None):
@@ -148,7 +293,8 @@ class GitHubTokenPool:
         return tokenState_list
 
     def validate_github_token(self, github_token, expect_valid_after=0):
-        response = requests.get('https://api.github.com/user', headers={'Authorization': f'token {github_token}'})
+        response = get_session().get('https://api.github.com/user', headers={'Authorization': f'token {github_token}'},
+                                     timeout=REQUEST_TIMEOUT)
         if response.status_code == 200 or 'Authorization' in response.headers.get("Vary", ""):
             valid = True
             # username = response.json()['login']
@@ -165,58 +311,122 @@ class GitHubTokenPool:
             valid = False
         return valid
 
-    def get_GithubToken(self):
-        if not self.tokenState_list:
-            self.tokenState_list = self.init_tokenState_list()
-
-        for tokenState in self.tokenState_list:
-            if tokenState['remaining'] > 0:
-                return tokenState['token']
-
-        self.minTime_tokenState = self.__class__.init_empty_tokenState()
-        for tokenState in self.tokenState_list:
-            if not self.minTime_tokenState["token"] or self.minTime_tokenState['reset'] > tokenState['reset']:
-                self.minTime_tokenState = tokenState
-
-        sleep_time = int(self.minTime_tokenState['reset'] - time.time())
-        if sleep_time > 0:
-            print(f'Sleep {str(sleep_time)} sec')
-            time.sleep(sleep_time)
-
-        return self.minTime_tokenState['token']
-
-    def update_GithubTokenState_list(self, token, response):
-        if response is None:  # bool(response[401]) = False if use `not response`!
-            return None
-        for i, tokenState in enumerate(self.tokenState_list):
-            if token == tokenState['token']:
-                if response.status_code in [429, 401, 403]:
-                    tokenState['remaining'] = 0
-                if 'X-RateLimit-Remaining' in response.headers:
-                    tokenState['remaining'] = int(response.headers['X-RateLimit-Remaining'])
-
-                if 'X-RateLimit-Reset' in response.headers:
-                    tokenState['reset'] = int(response.headers['X-RateLimit-Reset'])
-                elif 'Retry-After' in response.headers:
-                    tokenState['reset'] = int(time.time()) + int(response.headers['Retry-After']) + 1
-
-                # For authenticated requests, you can make up to 30 requests per minute for all search endpoints
-                # except for the "Search code" endpoint.
-                #   see https://docs.github.com/en/rest/search/search?apiVersion=2022-11-28#rate-limit
-                #   Notes: search limit rate on ip!
-                if 'X-Ratelimit-Resource' in response.headers:
-                    tokenState['resource'] = response.headers['X-Ratelimit-Resource']
-
-                if tokenState['remaining'] == 0 and tokenState['resource'] in self.ip_limit_resource:
-                    sleep_time = int(tokenState['reset'] - time.time())
-                    if sleep_time > 0:
-                        print(f'Sleep {str(sleep_time)} sec for ip limit rate.')
-                        time.sleep(sleep_time)
-                self.tokenState_list[i] = tokenState
+    @staticmethod
+    def get_resource_by_url(url):
+        url = str(url or '').rstrip('/')
+        if url.endswith('/graphql'):
+            return 'graphql'
+        elif '/search/code' in url:
+            return 'code_search'
+        elif '/search/' in url:
+            return 'search'
+        return 'core'
+
+    # 判断是否为限流响应: secondary rate limits return 403 with Retry-After rather than a zero remaining
+    @staticmethod
+    def is_rate_limited(response):
+        if response is None or response.status_code not in [403, 429]:
+            return False
+        return response.headers.get('X-RateLimit-Remaining', None) == '0' or 'Retry-After' in response.headers or \
+            'rate limit' in str(response.content).lower()
+
+    def get_token_bucket(self, resource='core'):
+        with self._cond:
+            bucket = self.token_buckets.setdefault(resource, {})
+            limit = self.__class__.resource_limits.get(resource, 1)
+            for tokenState in self.tokenState_list:
+                if tokenState['token'] not in bucket:
+                    # a single probe request per token until its rate limit headers are known
+                    bucket[tokenState['token']] = {"token": tokenState['token'], "remaining": 1 + self.reserve,
+                                                   "limit": limit, "reset": None, "resource": resource, "inflight": 0}
+            return bucket
+
+    # Acquire the token with the most available quota of the resource. Only the calling thread waits when all the
+    #   buckets of the resource run dry, the requests of the other resources go on. In a RateLimitDeferral, it raises
+    #   RateLimitDeferred instead of waiting for the quota reset.
+    def get_GithubToken(self, resource='core'):
+        with self._cond:
+            while True:
+                if not self.tokenState_list:
+                    self.tokenState_list = self.init_tokenState_list()
+                bucket = self.get_token_bucket(resource)
+                now = float(time.time())
+                available_tokenStates = []
+                for tokenState in bucket.values():
+                    if tokenState['remaining'] - tokenState['inflight'] <= self.reserve and \
+                            tokenState['reset'] is not None and tokenState['reset'] <= now:
+                        tokenState['remaining'] = tokenState['limit']  # the quota window has been reset
+                    if tokenState['remaining'] - tokenState['inflight'] > self.reserve:
+                        available_tokenStates.append(tokenState)
+                if available_tokenStates:
+                    tokenState = max(available_tokenStates, key=lambda s: s['remaining'] - s['inflight'])
+                    tokenState['inflight'] += 1
+                    return tokenState['token']
+
+                self.minTime_tokenState = min(bucket.values(), key=lambda s: s['reset'] or now)
+                sleep_time = (self.minTime_tokenState['reset'] or now) - now
+                deferral = getattr(_rate_limit_local, "deferral", None)
+                if deferral is not None and sleep_time > 0:
+                    deferral.defer(resource, self.minTime_tokenState['reset'])
+                    raise RateLimitDeferred(resource, self.minTime_tokenState['reset'])
+                if sleep_time >= 1:
+                    print(f'Sleep {str(int(sleep_time))} sec for {resource} rate limit.')
+                # wake up when the quota is reset, or when an in-flight request of the resource is released
+                self._cond.wait(timeout=max(sleep_time, 0.1))
+
+    def update_GithubTokenState_list(self, token, response, resource='core'):
+        with self._cond:
+            bucket = self.get_token_bucket(resource)
+            if token in bucket:
+                bucket[token]['inflight'] = max(bucket[token]['inflight'] - 1, 0)
+            if response is None:  # bool(response[401]) = False if use `not response`!
+                self._cond.notify_all()
+                return None
+            # For authenticated requests, you can make up to 30 requests per minute for all search endpoints
+            # except for the "Search code" endpoint.
+            #   see https://docs.github.com/en/rest/search/search?apiVersion=2022-11-28#rate-limit
+            #   Notes: search limit rate on ip!
+            resource = response.headers.get('X-Ratelimit-Resource', resource)
+            bucket = self.get_token_bucket(resource)
+            for i, tokenState in enumerate(self.tokenState_list):
+                if token == tokenState['token']:
+                    bucketState = bucket[token]
+                    if 'X-RateLimit-Limit' in response.headers:
+                        bucketState['limit'] = int(response.headers['X-RateLimit-Limit'])
+                    if 'X-RateLimit-Remaining' in response.headers:
+                        remaining = int(response.headers['X-RateLimit-Remaining'])
+                        reset = int(response.headers.get('X-RateLimit-Reset', 0)) or bucketState['reset']
+                        if bucketState['reset'] is not None and reset == bucketState['reset']:
+                            # the concurrent responses may arrive out of order in the same quota window
+                            remaining = min(remaining, bucketState['remaining'])
+                        bucketState['remaining'] = remaining
+                    if response.status_code in [429, 401] or self.is_rate_limited(response):
+                        bucketState['remaining'] = 0
+
+                    if 'Retry-After' in response.headers:
+                        bucketState['reset'] = int(time.time()) + int(response.headers['Retry-After']) + 1
+                    elif 'X-RateLimit-Reset' in response.headers:
+                        bucketState['reset'] = int(response.headers['X-RateLimit-Reset'])
+
+                    if bucketState['remaining'] == 0 and resource in self.ip_limit_resource:
+                        # the quota is shared by all the tokens on the same ip
+                        for otherState in bucket.values():
+                            otherState['remaining'] = 0
+                            if otherState['reset'] is None:  # the bucket of a token has not been probed yet
+                                otherState['reset'] = bucketState['reset']
+                            elif bucketState['reset'] is not None:
+                                otherState['reset'] = max(otherState['reset'], bucketState['reset'])
+                    tokenState.update({k: bucketState[k] for k in ["remaining", "reset", "resource"]})
+                    self.tokenState_list[i] = tokenState
+            self._cond.notify_all()
         return None
 
     def remove_GithubToken(self, token):
-        self.tokenState_list = [tokenState for tokenState in self.tokenState_list if tokenState['token'] != token]
+        with self._cond:
+            self.tokenState_list = [tokenState for tokenState in self.tokenState_list if tokenState['token'] != token]
+            for bucket in self.token_buckets.values():
+                bucket.pop(token, None)
+            self._cond.notify_all()
         return None
 
 
@@ -231,7 +441,14 @@ class RequestGitHubAPI(RequestAPI):
     }
     default_method = 'GET'
     url_pat_mode = 'name'
-    cache = QueryCache(max_size=200)
+    # the json fields kept in the cached responses, set None to keep the whole json
+    cache_json_keys = {'id', 'login', 'full_name', 'sha', 'number', 'pull_request', 'parents', 'name', 'commit',
+                       'items', 'message'}
+    cache = QueryCache(max_size=10000, name='github_rest_api', max_bytes=64 * 1024 * 1024)
+    # the persistent ETag/Last-Modified validators of the GET responses by url, see set_etag_store
+    etag_store = None
+    etag_namespace = 'github_rest_etag'
+    etag_ttl = 365 * 86400
 
     def __init__(self, url_pat_mode=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -265,6 +482,52 @@ class RequestGitHubAPI(RequestAPI):
             url += ext_pat.format(**params)
         return url
 
+    # Use a PersistentCacheStore to keep the ETag/Last-Modified validators with the responses: the GET requests missed
+    #   in the caches are sent with If-None-Match/If-Modified-Since, and a 304 Not Modified response, which does not
+    #   count against the primary rate limit, reuses the stored response.
+    @classmethod
+    def set_etag_store(cls, etag_store, namespace=None, ttl=None):
+        cls.etag_store = etag_store
+        cls.etag_namespace = namespace or cls.etag_namespace
+        cls.etag_ttl = ttl or cls.etag_ttl
+        return
+
+    def get_etag_record(self, url):
+        if self.etag_store is None:
+            return None
+        found, etag_record = self.etag_store.get(self.etag_namespace, PersistentCacheStore.get_key(["url"], url))
+        return etag_record if found else None
+
+    def put_etag_record(self, url, response):
+        if self.etag_store is None or response is None or response.status_code != 200:
+            return False
+        etag = response.headers.get('ETag', None)
+        last_modified = response.headers.get('Last-Modified', None)
+        if not etag and not last_modified:
+            return False
+        etag_record = {"url": url, "etag": etag, "last_modified": last_modified, "response": response}
+        return self.etag_store.put(self.etag_namespace, PersistentCacheStore.get_key(["url"], url), etag_record,
+                                   ttl=self.etag_ttl)
+
+    def request_conditional(self, url, method=None, retry=1, default_break=60, query=None, **kwargs):
+        etag_record = None
+        if (method or self.method).upper() == 'GET' and query is None:
+            etag_record = self.get_etag_record(url)
+        conditional_headers = {}
+        if etag_record is not None:
+            if etag_record.get("etag"):
+                conditional_headers['If-None-Match'] = etag_record["etag"]
+            if etag_record.get("last_modified"):
+                conditional_headers['If-Modified-Since'] = etag_record["last_modified"]
+        self.headers.update(conditional_headers)
+        try:
+            response = RequestAPI.request(self, url=url, method=method, retry=retry, default_break=default_break,
+                                          query=query, **kwargs)
+        finally:
+            for k in conditional_headers.keys():
+                self.headers.pop(k, None)
+        return response, etag_record
+
     def request(self, url, method=None, retry=1, default_break=60, query=None, **kwargs):
         url = url or self.base_url
         self.cache.match_func = partial(QueryCache.d_match_func, **{"feat_keys": kwargs.get("feat_keys", None) or
@@ -273,29 +536,47 @@ class RequestGitHubAPI(RequestAPI):
         record_info_cached = self.cache.find_record_in_cache(feature_new_rec)
         if record_info_cached:
             response = dict(record_info_cached).get("response", None)
-            if isinstance(response, requests.Response):
+            if isinstance(response, (requests.Response, CachedResponse)):
                 if response.status_code != 200:
                     print(f"Cache report: Error fetching {url}: {response.status_code}.")
             else:
                 print(f"Cache report: Error fetching {url}, failed to get response!")
         else:
-            self.token = self.token_pool.get_GithubToken()
-            self.update_headers()
-            response = RequestAPI.request(self, url=url, method=method, retry=retry, default_break=default_break,
-                                          query=query, **kwargs)
-            while 'bad credentials' in str(response.content).lower() or response.status_code == 403:
-                if 'bad credentials' in str(response.content).lower():
-                    print(f'Retry {response.url} after removing bad credentials.')
-                    self.token_pool.remove_GithubToken(self.token)
-                    # if not len(self.token_pool.tokenState_list) >= 2:
-                    #     self.token_pool.init_tokenState_list(inplace=True)
-                else:
-                    print(f'Retry {response.url} use another token.')
-                self.token = self.token_pool.get_GithubToken()
+            resource = self.token_pool.get_resource_by_url(url)
+            token_acquired = False  # release the in-flight quota of the token even if the request raises
+            try:
+                self.token = self.token_pool.get_GithubToken(resource)
+                token_acquired = True
                 self.update_headers()
-                response = RequestAPI.request(self, url=url, method=method, retry=retry, default_break=default_break,
-                                              query=query, **kwargs)
-            self.token_pool.update_GithubTokenState_list(self.token, response)
+                response, etag_record = self.request_conditional(url=url, method=method, retry=retry,
+                                                                 default_break=default_break, query=query, **kwargs)
+                while response is not None and ('bad credentials' in str(response.content).lower() or
+                                                self.token_pool.is_rate_limited(response)):
+                    token_acquired = False
+                    if 'bad credentials' in str(response.content).lower():
+                        print(f'Retry {response.url} after removing bad credentials.')
+                        self.token_pool.remove_GithubToken(self.token)
+                        # if not len(self.token_pool.tokenState_list) >= 2:
+                        #     self.token_pool.init_tokenState_list(inplace=True)
+                    else:
+                        print(f'Retry {response.url} use another token.')
+                        self.token_pool.update_GithubTokenState_list(self.token, response, resource)
+                    self.token = self.token_pool.get_GithubToken(resource)
+                    token_acquired = True
+                    self.update_headers()
+                    response, etag_record = self.request_conditional(url=url, method=method, retry=retry,
+                                                                     default_break=default_break, query=query,
+                                                                     **kwargs)
+                token_acquired = False
+                self.token_pool.update_GithubTokenState_list(self.token, response, resource)
+            finally:
+                if token_acquired:
+                    self.token_pool.update_GithubTokenState_list(self.token, None, resource)
+            response = CachedResponse.from_response(response, json_keys=self.cache_json_keys)
+            if response is not None and response.status_code == 304 and etag_record is not None:
+                response = etag_record["response"]  # Not Modified: reuse the stored response
+            else:
+                self.put_etag_record(url, response)
             new_record = dict(**feature_new_rec, **{"response": response})
             self.cache.add_record(new_record)
         return response
@@ -311,7 +592,10 @@ class GitHubGraphQLAPI(RequestAPI):
         'User-Agent': 'Mozilla/5.0 (Windows NT 6.4; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2225.0 Safari/537.36'
     }
     default_method = 'POST'
-    cache = QueryCache(max_size=200)
+    # the json fields kept in the cached responses, set None to keep the whole json
+    cache_json_keys = {'data', 'repository', 'ref', 'refs', 'target', 'oid', 'id', 'edges', 'node', 'name', 'cursor',
+                       'pageInfo', 'endCursor', 'hasNextPage', 'errors', 'message'}
+    cache = QueryCache(max_size=10000, name='github_graphql_api', max_bytes=64 * 1024 * 1024)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -322,39 +606,70 @@ class GitHubGraphQLAPI(RequestAPI):
     def request(self, query, url=None, method=None, retry=1, default_break=60, **kwargs):
         url = url or self.base_url
         self.cache.match_func = partial(QueryCache.d_match_func, **{"feat_keys": kwargs.get("feat_keys", None) or
-                                                                                 ["url", "method", "query"]})
-        feature_new_rec = {"url": url, "method": method, "query": query}
+                                                                                 ["url", "method", "query", "variables"]})
+        feature_new_rec = {"url": url, "method": method, "query": query, "variables": kwargs.get("variables", None)}
         record_info_cached = self.cache.find_record_in_cache(feature_new_rec)
         if record_info_cached:
             response = dict(record_info_cached).get("response", None)
-            if isinstance(response, requests.Response):
+            if isinstance(response, (requests.Response, CachedResponse)):
                 if response.status_code != 200:
                     print(f"Cache report: Error fetching {url}: {response.status_code}.")
             else:
                 print(f"Cache report: Error fetching {url}, failed to get response!")
         else:
-            self.token = self.token_pool.get_GithubToken()
-            self.update_headers()
-            response = RequestAPI.request(self, query=query, url=url, method=method, retry=retry,
-                                          default_break=default_break, **kwargs)
-            while 'bad credentials' in str(response.content).lower() or response.status_code == 403:
-                if 'bad credentials' in str(response.content).lower():
-                    print(f'Retry {response.url} after removing bad credentials.')
-                    self.token_pool.remove_GithubToken(self.token)
-                    # if not len(self.token_pool.tokenState_list) >= 2:
-                    #     self.token_pool.init_tokenState_list(inplace=True)
-                else:
-                    print(f'Retry {response.url} use another token.')
-                self.token = self.token_pool.get_GithubToken()
+            resource = 'graphql'
+            token_acquired = False  # release the in-flight quota of the token even if the request raises
+            try:
+                self.token = self.token_pool.get_GithubToken(resource)
+                token_acquired = True
                 self.update_headers()
                 response = RequestAPI.request(self, query=query, url=url, method=method, retry=retry,
                                               default_break=default_break, **kwargs)
-            self.token_pool.update_GithubTokenState_list(self.token, response)
+                while response is not None and ('bad credentials' in str(response.content).lower() or
+                                                self.token_pool.is_rate_limited(response)):
+                    token_acquired = False
+                    if 'bad credentials' in str(response.content).lower():
+                        print(f'Retry {response.url} after removing bad credentials.')
+                        self.token_pool.remove_GithubToken(self.token)
+                        # if not len(self.token_pool.tokenState_list) >= 2:
+                        #     self.token_pool.init_tokenState_list(inplace=True)
+                    else:
+                        print(f'Retry {response.url} use another token.')
+                        self.token_pool.update_GithubTokenState_list(self.token, response, resource)
+                    self.token = self.token_pool.get_GithubToken(resource)
+                    token_acquired = True
+                    self.update_headers()
+                    response = RequestAPI.request(self, query=query, url=url, method=method, retry=retry,
+                                                  default_break=default_break, **kwargs)
+                token_acquired = False
+                self.token_pool.update_GithubTokenState_list(self.token, response, resource)
+            finally:
+                if token_acquired:
+                    self.token_pool.update_GithubTokenState_list(self.token, None, resource)
+            response = CachedResponse.from_response(response, json_keys=self.cache_json_keys)
             new_record = dict(**feature_new_rec, **{"response": response})
             self.cache.add_record(new_record)
         return response
 
 
+# Run the GitHub API requests concurrently by a thread pool. The token pool is thread-safe: each request acquires the
+#   token with the most remaining quota of its resource (core, search, graphql), so the requests are spread over all
+#   the tokens, and a worker only waits when every token bucket of its resource runs dry.
+class GitHubRequestExecutor:
+    workers_per_token = 4
+
+    def __init__(self, max_workers=None, token_pool=None):
+        self.token_pool = token_pool or RequestGitHubAPI.token_pool
+        self.max_workers = max_workers or max(1, min(32, len(self.token_pool.tokenState_list) *
+                                                     self.__class__.workers_per_token))
+
+    # The thread pool to submit the tasks issuing GitHub API requests, e.g. the link searches of resolve_links.
+    # n_tasks: no more threads than the tasks are started.
+    def get_thread_pool(self, n_tasks=None):
+        max_workers = self.max_workers if n_tasks is None else max(1, min(self.max_workers, n_tasks))
+        return ThreadPoolExecutor(max_workers=max_workers)
+
+
 if __name__ == '__main__':
     repo_name = "redis/redis"
     query_tags = """
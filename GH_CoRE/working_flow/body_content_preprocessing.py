@@ -80,6 +80,51 @@ def dedup_content(df_repo):  # 数据库存储时将repo_description等信息重
     return temp_df_repo
 
 
+# Read a csv file chunk by chunk, set dedup=True to deduplicate the content of each chunk by dedup_content. The reader
+#   can be iterated many times and pickled, so that it can be sent to the worker processes instead of the DataFrames.
+class CsvChunkReader:
+    def __init__(self, csv_path, chunksize=10000, dedup=False, header='infer', index_col=None, **kwargs):
+        self.csv_path = csv_path
+        self.chunksize = chunksize
+        self.dedup = dedup
+        self.header = header
+        self.index_col = index_col
+        self.kwargs = kwargs
+
+    def __iter__(self):
+        kwargs = dict(self.kwargs)
+        kwargs["low_memory"] = kwargs.get("low_memory", False)
+        with pd.read_csv(self.csv_path, header=self.header, index_col=self.index_col, chunksize=self.chunksize,
+                         **kwargs) as df_chunks:
+            for df_chunk in df_chunks:
+                if self.dedup:
+                    df_chunk = dedup_content(df_chunk)
+                    if df_chunk is None:  # raise rather than end the iteration, or the repo would be taken as completed
+                        raise ValueError(f"MissingColumnsError: {self.csv_path} misses the columns required by "
+                                         f"dedup_content!")
+                yield df_chunk
+
+    def __repr__(self):
+        return f"CsvChunkReader({self.csv_path}, chunksize={self.chunksize}, dedup={self.dedup})"
+
+
+# The streaming version of read_csvs, returns {'filename1': CsvChunkReader1, 'filename2': CsvChunkReader2} without reading
+#   the csv files.
+def get_csv_chunk_readers(csv_dir, filenames=None, chunksize=10000, dedup=False, header='infer', index_col=None, **kwargs):
+    reader_dict = {}
+    filenames = filenames if filenames is not None else os.listdir(csv_dir)
+    for full_file_name in filenames:
+        file_name, suffix = os.path.splitext(full_file_name)
+        if suffix == '.csv':
+            csv_path = os.path.join(csv_dir, full_file_name)
+            if not os.path.exists(csv_path):
+                print(f"[Errno 2] No such file or directory: '{csv_path}'", 'It will be ignored.')
+                continue
+            reader_dict[file_name] = CsvChunkReader(csv_path, chunksize=chunksize, dedup=dedup, header=header,
+                                                    index_col=index_col, **kwargs)
+    return reader_dict
+
+
 if __name__ == '__main__':
     from etc import filePathConf
 
@@ -6,10 +6,15 @@
 # @Author : 'Lou Zehua'
 # @File   : query_OSDB_github_log.py
 
+import json
 import os
+import re
+import threading
+import time
 
 import pandas as pd
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from GH_CoRE.data_dict_settings import columns_simple
 from GH_CoRE.utils.conndb import ConnDB
 
@@ -22,45 +27,356 @@ def get_repo_year_filename(repo_name_fileformat: str, year):
     return f"{repo_name_fileformat}_{str(year)}.csv"
 
 
-def query_repo_log_each_year_to_csv_dir(repo_names, columns, save_dir, sql_param=None, update_exist_data=False):
-    conndb = ConnDB()
-    columns_str = ', '.join(columns)
-    sql_param = sql_param or {}
-    sql_param = dict(sql_param)
-    table = sql_param.get("table", "opensource.events")
+def get_year_constraint(year, end_year=None):
+    return f"created_at BETWEEN '{str(year)}-01-01 00:00:00' AND '{str(end_year or (year + 1))}-01-01 00:00:00'"
+
+
+def get_part_paths(save_path):
+    # the partial file and its sidecar with the resume state of a streaming download
+    part_path = save_path + '.part'
+    return part_path, part_path + '.json'
+
+
+def _load_part_state(part_path, state_path, sql):
+    if not os.path.exists(part_path) or not os.path.exists(state_path):
+        return None
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get("sql") != sql or os.path.getsize(part_path) < state.get("size", 0):
+        return None  # the partial file belongs to another query or is damaged, download it again
+    return state
+
+
+def _dump_part_state(state_path, state):
+    temp_path = state_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(temp_path, state_path)
+
+
+# The pandas dtype of a ClickHouse column type. The dtypes are fixed by the column types rather than inferred from the
+#   values, so that every block of a query is formatted in the same way, e.g. the integers of a block with NULLs are
+#   not turned into floats. The other types are kept as python objects.
+def get_column_dtype(column_type):
+    column_type = re.sub(r'^LowCardinality\((.*)\)$', r'\1', column_type)
+    column_type = re.sub(r'^Nullable\((.*)\)$', r'\1', column_type)
+    if re.match(r'^Int(8|16|32|64)$', column_type):
+        return 'Int64'
+    if re.match(r'^UInt(8|16|32|64)$', column_type):
+        return 'UInt64'
+    if re.match(r'^Float(32|64)$', column_type):
+        return 'float64'
+    return object
+
+
+# columns_with_types: [(name, type)] as returned by the queries with_column_types; data: the values of each column.
+def build_typed_dataframe(columns_with_types, data):
+    data = data or [[] for _ in columns_with_types]
+    return pd.DataFrame({name: pd.Series(list(values), dtype=get_column_dtype(column_type))
+                         for (name, column_type), values in zip(columns_with_types, data)},
+                        columns=[name for name, _ in columns_with_types])
+
+
+# Append the rows to the binary file f in the format of `df.to_csv(f, header=header, index=True)`, the DataFrame is
+#   built by build_typed_dataframe, with the index starting from start_index.
+# return: the number of rows.
+def write_csv_block(f, columns_with_types, rows, start_index=0, header=False):
+    df_block = build_typed_dataframe(columns_with_types, list(zip(*rows)))
+    df_block.index = pd.RangeIndex(start_index, start_index + len(df_block))
+    df_block.to_csv(f, header=header, index=True, encoding='utf-8', lineterminator='\n', mode='wb')
+    return len(df_block)
+
+
+# Stream the result of sql into save_path block by block instead of materializing it in memory: each block of at most
+#   max_block_size rows is appended to save_path + '.part' as soon as it arrives, and the running row count and file
+#   size are recorded in the sidecar save_path + '.part.json' after each block. The partial file is renamed to
+#   save_path when the query completes.
+# order_by: a key that totally orders the rows, so an interrupted download can be resumed from the partial file by
+#   skipping the rows written, e.g. 'created_at, id'. Resuming is disabled if order_by is None.
+# The csv format is the same as `df.to_csv(save_path, header=True, index=True)` with a continuous RangeIndex.
+# return: the number of rows saved.
+def stream_query_to_csv(sql, save_path, conndb=None, max_block_size=65536, order_by=None, resume=True,
+                        show_progress=True):
+    conndb = conndb or ConnDB()
+    sql = sql.strip().rstrip(';')
+    if order_by:
+        sql = f"{sql} ORDER BY {order_by}"
+    part_path, state_path = get_part_paths(save_path)
+
+    def download(client):
+        state = _load_part_state(part_path, state_path, sql) if resume and order_by else None
+        state = state or {"sql": sql, "rows": 0, "size": 0}
+        sql_offset = f"{sql} OFFSET {state['rows']}" if state["rows"] else sql
+        if state["rows"]:
+            print(f"Resume {os.path.basename(save_path)} from row {state['rows']}.")
+        rows_iter = client.execute_iter(sql_offset, with_column_types=True,
+                                        settings={"max_block_size": max_block_size})
+        with open(part_path, 'r+b' if state["size"] else 'wb') as f:
+            f.truncate(state["size"])  # drop the rows written after the last recorded block
+            f.seek(state["size"])
+            columns_with_types = None
+            block = []
+
+            def write_block():
+                state["rows"] += write_csv_block(f, columns_with_types, block, state["rows"], header=not state["size"])
+                f.flush()
+                os.fsync(f.fileno())
+                state["size"] = f.tell()
+                _dump_part_state(state_path, state)
+                block.clear()
+                if show_progress:
+                    print(f"{os.path.basename(save_path)}: {state['rows']} rows saved...")
+
+            for row in rows_iter:
+                if columns_with_types is None:  # the first item is the column names and types
+                    columns_with_types = row
+                    continue
+                block.append(row)
+                if len(block) >= max_block_size:
+                    write_block()
+            if block or not state["size"]:
+                write_block()
+        return state["rows"]
+
+    n_rows = conndb.run_with_client(download)
+    os.replace(part_path, save_path)
+    os.remove(state_path)
+    return n_rows
+
+
+def get_sql_param_years(sql_param):
     start_end_year = sql_param.get("start_end_year", [2022, 2023])
     start_year = start_end_year[0]
     try:
         end_year = start_end_year[1]
     except IndexError:
         end_year = start_year + 1
-    get_year_constraint = lambda x, y=None: f"created_at BETWEEN '{str(x)}-01-01 00:00:00' AND '{str(y or (x + 1))}-01-01 00:00:00'"
-
-    # query and save
-    for year in range(start_year, end_year):
-        sql_ref_repo_pattern = f'''
-        SELECT {{columns}} FROM {table} WHERE platform='GitHub' AND {get_year_constraint(year)} AND repo_name='{{repo_name}}';
-        '''
-        for repo_name in repo_names:
-            sql_ref_repo = sql_ref_repo_pattern.format(**{"columns": columns_str, "repo_name": repo_name})
-            # print(sql_ref_repo)
-
-            repo_name_fileformat = get_repo_name_fileformat(repo_name)
-            filename = get_repo_year_filename(repo_name_fileformat, year)
-            save_path = os.path.join(save_dir, filename)
-
-            if update_exist_data or not os.path.exists(save_path):
-                conndb.sql = sql_ref_repo
-                try:
-                    conndb.execute()
-                    conndb.rs.to_csv(save_path, header=True, index=True, encoding='utf-8', lineterminator='\n')
-                except BaseException as e:
-                    print(f"{filename} is skipped due to an unexpected error: {e.__class__.__name__}!")
+    return list(range(start_year, end_year))
+
+
+def get_repo_year_sql(repo_name, year, columns, table="opensource.events"):
+    return f"""
+        SELECT {', '.join(columns)} FROM {table} WHERE platform='GitHub' AND {get_year_constraint(year)} AND repo_name='{repo_name}';
+        """
+
+
+# Download the log of a (repo_name, year) unit into save_path. return: the number of rows saved.
+def download_repo_year(repo_name, year, columns, save_path, sql_param=None, conndb=None, stream=False,
+                       max_block_size=65536):
+    sql_param = dict(sql_param or {})
+    conndb = conndb or ConnDB(exit_on_error=False)
+    sql = get_repo_year_sql(repo_name, year, columns, table=sql_param.get("table", "opensource.events"))
+    if stream:
+        order_by = sql_param.get("order_by", "created_at, id")  # the total order to resume the streaming downloads
+        return stream_query_to_csv(sql, save_path, conndb=conndb, max_block_size=max_block_size, order_by=order_by,
+                                   show_progress=False)
+    conndb.sql = sql
+    # the same dtypes as the streamed blocks, see build_typed_dataframe
+    data, columns_with_types = conndb.run_with_client(
+        lambda client: client.execute(sql, columnar=True, with_column_types=True))
+    df_rs = build_typed_dataframe(columns_with_types, data)
+    temp_path = save_path + '.tmp'  # never leave a truncated csv behind
+    df_rs.to_csv(temp_path, header=True, index=True, encoding='utf-8', lineterminator='\n')
+    os.replace(temp_path, save_path)
+    return len(df_rs)
+
+
+# The status of each (repo_name, year) unit of a download job, saved as a json file after each change:
+#   {filename: {"repo_name", "year", "status": 'pending'|'running'|'done'|'exists'|'failed', "attempts", "rows",
+#   "error", "updated_at"}}
+class DownloadManifest:
+    def __init__(self, path=None):
+        self.path = path
+        self.units = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.units = json.load(f)
+            except (OSError, ValueError):
+                print(f"The manifest {path} is damaged and will be rebuilt.")
+
+    def get(self, filename):
+        with self._lock:
+            return dict(self.units.get(filename, {}))
+
+    def update(self, filename, **kwargs):
+        with self._lock:
+            unit = self.units.setdefault(filename, {"attempts": 0})
+            unit.update(kwargs, updated_at=time.strftime('%Y-%m-%d %H:%M:%S'))
+            if self.path:
+                temp_path = self.path + '.tmp'
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(self.units, f, indent=1, ensure_ascii=False)
+                os.replace(temp_path, self.path)
+
+    def count(self):
+        d_count = {}
+        with self._lock:
+            for unit in self.units.values():
+                d_count[unit.get("status")] = d_count.get(unit.get("status"), 0) + 1
+        return d_count
+
+
+def get_repos_year_sql(repo_names, year, columns, table="opensource.events"):
+    repo_names_str = ', '.join(f"'{repo_name}'" for repo_name in repo_names)
+    return f"""
+        SELECT {', '.join(columns)} FROM {table} WHERE platform='GitHub' AND {get_year_constraint(year)} AND repo_name IN ({repo_names_str});
+        """
+
+
+# Download the logs of many repos in a year with a single scan of the year partition: the rows of
+#   `repo_name IN (...)` are streamed and demultiplexed by repo_name into the per-repo files named by
+#   get_repo_year_filename, in the same csv format as download_repo_year. At most max_block_size rows are buffered
+#   in memory. The files are written to save_path + '.tmp' and renamed when the whole query completes, a failed batch
+#   is downloaded again from the beginning.
+# return: {repo_name: the number of rows saved}
+def download_repos_year(repo_names, year, columns, save_dir, sql_param=None, conndb=None, max_block_size=65536):
+    sql_param = dict(sql_param or {})
+    conndb = conndb or ConnDB(exit_on_error=False)
+    query_columns = list(columns) if 'repo_name' in columns else list(columns) + ['repo_name']
+    i_repo_name = query_columns.index('repo_name')
+    sql = get_repos_year_sql(repo_names, year, query_columns, table=sql_param.get("table", "opensource.events"))
+    save_paths = {repo_name: os.path.join(save_dir, get_repo_year_filename(get_repo_name_fileformat(repo_name), year))
+                  for repo_name in repo_names}
+
+    def download(client):
+        files = {}
+        d_n_rows = {repo_name: 0 for repo_name in repo_names}
+        d_blocks = {repo_name: [] for repo_name in repo_names}
+        n_buffered = 0
+        columns_with_types = []  # the column types of the requested columns
+
+        def write_blocks():
+            for repo_name, block in d_blocks.items():
+                header = repo_name not in files
+                if not block and not header:
+                    continue
+                if header:
+                    files[repo_name] = open(save_paths[repo_name] + '.tmp', 'wb')
+                if query_columns != list(columns):  # drop the repo_name column only used to demultiplex the rows
+                    block = [row[:i_repo_name] + row[i_repo_name + 1:] for row in block]
+                d_n_rows[repo_name] += write_csv_block(files[repo_name], columns_with_types, block, d_n_rows[repo_name],
+                                                       header=header)
+                d_blocks[repo_name].clear()
+
+        try:
+            rows_iter = client.execute_iter(sql, with_column_types=True, settings={"max_block_size": max_block_size})
+            columns_with_types[:] = [column for column in next(rows_iter) if column[0] in columns]
+            for row in rows_iter:
+                d_blocks[row[i_repo_name]].append(row)
+                n_buffered += 1
+                if n_buffered >= max_block_size:
+                    write_blocks()
+                    n_buffered = 0
+            write_blocks()  # the repos without any rows get a file with only the header, as download_repo_year
+        finally:
+            for f in files.values():
+                f.close()
+        return d_n_rows
+
+    d_n_rows = conndb.run_with_client(download)
+    for repo_name, save_path in save_paths.items():
+        os.replace(save_path + '.tmp', save_path)
+    return d_n_rows
+
+
+# Download the (repo_name, year) units with at most `workers` concurrent ClickHouse sessions. A failed unit is retried
+#   `retry` times after a backoff of backoff * 2 ** (attempt - 1) seconds, the units still failing are recorded in
+#   the manifest and the others continue. The units that have been saved are skipped unless update_exist_data.
+# batch_size: download up to batch_size repos of the same year with one scan by download_repos_year, the units of a
+#   batch are retried together. Each unit is queried alone if batch_size is 1.
+# manifest_path: the status file of the units, default: save_dir/download_manifest.json.
+# return: the DownloadManifest of the units.
+def download_repo_year_units(units, columns, save_dir, sql_param=None, update_exist_data=False, workers=1, retry=2,
+                             backoff=5, stream=False, max_block_size=65536, manifest_path=None, batch_size=1):
+    sql_param = dict(sql_param or {})
+    manifest_path = manifest_path or os.path.join(save_dir, "download_manifest.json")
+    manifest = DownloadManifest(manifest_path)
+    pool_size = max(ConnDB.pool_size, workers)  # the pooled clients of this process are shared by the workers
+    get_filename = lambda repo_name, year: get_repo_year_filename(get_repo_name_fileformat(repo_name), year)
+
+    # batch: [(repo_name, year)] of the same year
+    def download(batch):
+        attempts = 0
+        while True:
+            attempts += 1
+            for repo_name, year in batch:
+                filename = get_filename(repo_name, year)
+                manifest.update(filename, repo_name=repo_name, year=year, status='running',
+                                attempts=manifest.get(filename).get("attempts", 0) + 1)
+            conndb = ConnDB(pool_size=pool_size, exit_on_error=False)
+            try:
+                if len(batch) == 1:
+                    repo_name, year = batch[0]
+                    save_path = os.path.join(save_dir, get_filename(repo_name, year))
+                    d_n_rows = {repo_name: download_repo_year(repo_name, year, columns, save_path, sql_param=sql_param,
+                                                              conndb=conndb, stream=stream,
+                                                              max_block_size=max_block_size)}
+                else:
+                    d_n_rows = download_repos_year([repo_name for repo_name, _ in batch], batch[0][1], columns,
+                                                   save_dir, sql_param=sql_param, conndb=conndb,
+                                                   max_block_size=max_block_size)
+            except Exception as e:
+                error = f"{e.__class__.__name__}: {str(e)[:200]}"
+                failed = attempts > retry
+                for repo_name, year in batch:
+                    manifest.update(get_filename(repo_name, year), status='failed' if failed else 'pending',
+                                    error=error)
+                if failed:
+                    for repo_name, year in batch:
+                        print(f"{get_filename(repo_name, year)} is skipped due to an unexpected error: "
+                              f"{e.__class__.__name__}!")
                     return
-                print(f"{filename} saved!")
-            else:
-                print(f"{filename} exists!")
-    print("Query Completed!")
+                delay = backoff * 2 ** (attempts - 1)
+                print(f"{len(batch)} files failed: {error}. Retry in {delay}s.")
+                time.sleep(delay)
+                continue
+            for repo_name, year in batch:
+                manifest.update(get_filename(repo_name, year), status='done', rows=d_n_rows[repo_name], error=None)
+                print(f"{get_filename(repo_name, year)} saved!")
+            return
+
+    d_year_units = {}  # {year: [(repo_name, year)]} of the units to download
+    for repo_name, year in units:
+        filename = get_filename(repo_name, year)
+        if not update_exist_data and os.path.exists(os.path.join(save_dir, filename)):
+            manifest.update(filename, repo_name=repo_name, year=year, status='exists', error=None)
+            print(f"{filename} exists!")
+            continue
+        d_year_units.setdefault(year, []).append((repo_name, year))
+    batch_size = max(batch_size, 1)
+    batches = [year_units[i: i + batch_size] for year_units in d_year_units.values()
+               for i in range(0, len(year_units), batch_size)]
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = [executor.submit(download, batch) for batch in batches]
+        for future in as_completed(futures):
+            future.result()
+    return manifest
+
+
+# stream: download each file block by block with stream_query_to_csv, an interrupted download is resumed from its
+#   partial file when the same query is run again. Otherwise each file is queried into a DataFrame before it is saved.
+# workers: the number of (repo_name, year) units downloaded concurrently, default 1 to keep a single session,
+#   see download_repo_year_units.
+# batch_size: the number of repos downloaded with one scan of a year, e.g. 50 to download all the OSDB repos in a
+#   few queries, see download_repos_year.
+def query_repo_log_each_year_to_csv_dir(repo_names, columns, save_dir, sql_param=None, update_exist_data=False,
+                                        stream=False, max_block_size=65536, workers=1, retry=2, backoff=5,
+                                        batch_size=1):
+    sql_param = dict(sql_param or {})
+    units = [(repo_name, year) for year in get_sql_param_years(sql_param) for repo_name in repo_names]
+    manifest = download_repo_year_units(units, columns, save_dir, sql_param, update_exist_data=update_exist_data,
+                                        workers=workers, retry=retry, backoff=backoff, stream=stream,
+                                        max_block_size=max_block_size, batch_size=batch_size)
+    d_count = manifest.count()
+    if d_count.get('failed'):
+        print(f"Query Completed with {d_count['failed']} failed units, see {manifest.path}! Status counts: {d_count}")
+    else:
+        print("Query Completed!")
     return
 
 
@@ -8,7 +8,9 @@
 
 import os
 import sys
+import time
 import traceback
+from collections import OrderedDict
 
 if '__file__' not in globals():
     # !pip install ipynbname  # Remove comment symbols to solve the ModuleNotFoundError
@@ -23,19 +25,28 @@ if pkg_rootdir not in sys.path:  # 解决ipynb引用上层路径中的模块时
     print('-- Add root directory "{}" to system path.'.format(pkg_rootdir))
 
 import logging
+import multiprocessing
 import pandas as pd
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from functools import partial
+from logging.handlers import QueueHandler, QueueListener
 
 from etc import filePathConf
 from GH_CoRE.data_dict_settings import columns_simple
-from GH_CoRE.working_flow.body_content_preprocessing import read_csvs, dedup_content
+from GH_CoRE.model.Attribute_getter import enable_persistent_cache
+from GH_CoRE.model.Entity_recognition import get_d_bodyRegLinks_eachLinkPatType_by_index
+from GH_CoRE.working_flow.body_content_preprocessing import read_csvs, dedup_content, get_csv_chunk_readers
 from GH_CoRE.model.Relation_extraction import get_obj_collaboration_tuples_from_record, get_df_collaboration, \
-    save_GitHub_Collaboration_Network
+    get_df_collaboration_EventAction, CollaborationNetworkWriter, CollaborationNetworkJournal, CollaborationTableBuilder, \
+    DeferredCollaborationBuffer, collect_unresolved_links, resolve_links, warm_link_cache_from_csv
 from GH_CoRE.working_flow.query_OSDB_github_log import query_repo_log_each_year_to_csv_dir, get_repo_name_fileformat, \
     get_repo_year_filename
-from GH_CoRE.utils.cache import QueryCache
+from GH_CoRE.utils.cache import QueryCache, get_cache_stats, format_cache_stats, save_cache_stats
 from GH_CoRE.utils.logUtils import setup_logging
+from GH_CoRE.utils.request_api import RateLimitDeferral, RateLimitDeferred
+
+logger = logging.getLogger(__name__)
 
 
 def query_OSDB_github_log_from_dbserver(key_feats_path=None, save_dir=None, update_exist_data=False):
@@ -57,7 +68,9 @@ def query_OSDB_github_log_from_dbserver(key_feats_path=None, save_dir=None, upda
         "table": "opensource.gh_events",
         "start_end_year": [2022, 2023],
     }
-    query_repo_log_each_year_to_csv_dir(repo_names, columns, save_dir, sql_param, update_exist_data=UPDATE_EXIST_DATA)
+    # scan each year once for every 50 repos instead of once for every repo, with 4 concurrent sessions
+    query_repo_log_each_year_to_csv_dir(repo_names, columns, save_dir, sql_param, update_exist_data=UPDATE_EXIST_DATA,
+                                        workers=4, batch_size=50)
     return
 
 
@@ -79,20 +92,295 @@ def process_body_content(raw_content_dir=None, processed_content_dir=None, filen
     return
 
 
+def get_link_cache(cache_max_size=200, persistent_store=None):
+    cache = QueryCache(max_size=cache_max_size, name='link') if cache_max_size > 0 else None
+    if cache is not None:
+        cache.match_func = partial(QueryCache.d_match_func,
+                                   **{"feat_keys": ["link_pattern_type", "link_text", "rec_repo_id"]})
+        if persistent_store is not None:
+            cache.set_persistent_store(persistent_store, 'link')
+    return cache
+
+
+CACHE_STATS_LOG_INTERVAL = 300  # seconds
+_cache_stats_logged_at = {"time": time.time()}
+
+
+# Log the statistics of the named caches into the run log every CACHE_STATS_LOG_INTERVAL seconds, or at once if force.
+def log_cache_stats(msg_prefix='', force=False):
+    now = time.time()
+    if force or now - _cache_stats_logged_at["time"] >= CACHE_STATS_LOG_INTERVAL:
+        logger.info(f"Cache statistics: {msg_prefix}{format_cache_stats(get_cache_stats())}")
+        _cache_stats_logged_at["time"] = now
+
+
+# Extract the collaboration relations of df_records and write them by the writer, all the records are to be processed.
+# defer_rate_limit: when the GitHub rate limits of all the tokens are exceeded, put off the records depending on the API
+#   instead of sleeping until the quota is reset: the other records keep being extracted, the deferred records are retried
+#   after the reset and their relations are patched into place, the rows are still written in the order of the records.
+# process_checkpoint: [repo_key, repo_loc, record_loc], the record_loc is updated in place to locate the stopped record.
+def records_collaboration_relation_extraction(df_records, writer, cache=None, use_relation_type_list=None,
+                                              batch_ner=True, vectorized_event_action=True, link_workers=0,
+                                              defer_rate_limit=False, process_checkpoint=None):
+    I_RECORD_LOC = 2
+    process_checkpoint = process_checkpoint if process_checkpoint is not None else ['', 0, 0]
+    d_bodyRegLinks_eachLinkPatType_by_index = None
+    if batch_ner:
+        d_bodyRegLinks_eachLinkPatType_by_index = get_d_bodyRegLinks_eachLinkPatType_by_index(df_records)
+    d_EventAction_records_by_index = None
+    if vectorized_event_action:
+        df_collaboration_EventAction, d_record_ext_by_index, fallback_indexes = get_df_collaboration_EventAction(
+            df_records, use_relation_type_list=use_relation_type_list, extend_field=True)
+        d_EventAction_records_by_index = {}
+        for index, record in zip(df_collaboration_EventAction.index, df_collaboration_EventAction.to_dict('records')):
+            d_EventAction_records_by_index.setdefault(index, []).append(record)
+        fallback_indexes = set(fallback_indexes)
+    resolved_links = None
+    d_deferred_links = {} if defer_rate_limit else None  # {link_feature_key: (link_feature, d_record, reset)}
+    if link_workers > 0:
+        # two-phase link resolution: collect the distinct body links and resolve them in bulk before emitting relations
+        d_unresolved_links = collect_unresolved_links(
+            df_records, d_bodyRegLinks_eachLinkPatType_by_index=d_bodyRegLinks_eachLinkPatType_by_index,
+            use_relation_type_list=use_relation_type_list,
+            d_record_ext_by_index=d_record_ext_by_index if vectorized_event_action else None, cache=cache)
+        resolved_links = resolve_links(d_unresolved_links, workers=link_workers, cache=cache,
+                                       d_deferred_links=d_deferred_links)
+
+    # add the relations of a record into the builder, nothing is added if RateLimitDeferred is raised
+    def add_record_relations(index, rec, builder, defer):
+        if defer:
+            with RateLimitDeferral() as deferral:  # any GitHub request of the record, not only the link searches
+                EventAction_records, obj_collaboration_tuple_list, rec_id = get_record_relations(index, rec, defer)
+            if deferral.deferred:  # the relations may be incomplete if the callee caught RateLimitDeferred
+                raise RateLimitDeferred(deferral.resource, deferral.reset)
+        else:
+            EventAction_records, obj_collaboration_tuple_list, rec_id = get_record_relations(index, rec, defer)
+        builder.add_records(EventAction_records, index=index)
+        builder.add_tuples(obj_collaboration_tuple_list, index=index)
+        builder.checkpoint = {"last_index": index, "last_event_id": rec_id}
+
+    def get_record_relations(index, rec, defer):
+        nonlocal cache
+        linkPatType_body_regexed_links_dict = d_bodyRegLinks_eachLinkPatType_by_index.get(index, {}) \
+            if d_bodyRegLinks_eachLinkPatType_by_index is not None else None
+        EventAction_records = []
+        if d_EventAction_records_by_index is not None and index not in fallback_indexes:
+            # the EventAction relations are prepared, only extract the relations from body links
+            rec = dict(rec.to_dict(), **d_record_ext_by_index.get(index, {}))
+            obj_collaboration_tuple_list, cache = get_obj_collaboration_tuples_from_record(
+                rec, extract_mode=1, cache=cache, use_relation_type_list=use_relation_type_list,
+                linkPatType_body_regexed_links_dict=linkPatType_body_regexed_links_dict,
+                resolved_links=resolved_links, defer=defer, deferred_links=d_deferred_links)
+            EventAction_records = d_EventAction_records_by_index.get(index, [])
+        else:
+            obj_collaboration_tuple_list, cache = get_obj_collaboration_tuples_from_record(
+                rec, cache=cache, use_relation_type_list=use_relation_type_list,
+                linkPatType_body_regexed_links_dict=linkPatType_body_regexed_links_dict,
+                resolved_links=resolved_links, defer=defer, deferred_links=d_deferred_links)
+        return EventAction_records, obj_collaboration_tuple_list, rec.get('id')
+
+    # retry the deferred links and records, wait for the rate limit reset if not defer
+    def drain_deferred(defer):
+        reset = None  # the quota is still exceeded until reset
+        if d_deferred_links:
+            d_retry_links = OrderedDict((key, (feature, d_record))
+                                        for key, (feature, d_record, _) in d_deferred_links.items())
+            d_deferred_links.clear()
+            resolved_links_retried = resolve_links(d_retry_links, workers=link_workers, cache=cache,
+                                                   d_deferred_links=d_deferred_links if defer else None)
+            if resolved_links is not None:
+                resolved_links.update(resolved_links_retried)
+            if d_deferred_links:
+                reset = min(link_reset for _, _, link_reset in d_deferred_links.values())
+        for index, rec, _ in buffer.get_deferred():
+            if reset is None:
+                builder = CollaborationTableBuilder(extend_field=True)
+                try:
+                    add_record_relations(index, rec, builder, defer)
+                    buffer.patch(index, builder)
+                    continue
+                except RateLimitDeferred as e:
+                    reset = e.reset
+            buffer.defer(index, rec, reset)
+
+    def write_ready():
+        for df_collaboration, checkpoint in buffer.pop_ready():
+            writer.write(df_collaboration, checkpoint=checkpoint)
+
+    buffer = DeferredCollaborationBuffer(extend_field=True)
+    try:
+        for index, rec in df_records.iterrows():
+            process_checkpoint[I_RECORD_LOC] = index
+            if buffer.n_deferred() and time.time() >= buffer.next_reset():
+                drain_deferred(defer=True)
+            try:
+                add_record_relations(index, rec, buffer.builder, defer_rate_limit)
+            except RateLimitDeferred as e:
+                buffer.defer(index, rec, e.reset)
+            if len(buffer) >= writer.flush_rows or writer.flush_due():
+                write_ready()
+                log_cache_stats()
+        if buffer.n_deferred():
+            logger.info(f"Rate limit: waiting for the quota reset to patch the relations of {buffer.n_deferred()} "
+                        f"deferred records.")
+            drain_deferred(defer=False)
+    finally:  # keep the relations of the finished records when an exception is raised
+        write_ready()
+    return cache
+
+
+# {event_id: repo_id} of the repo event logs, a DataFrame or a CsvChunkReader, to locate the records of the body links.
+def get_d_event_repo_id(df_repo):
+    if isinstance(df_repo, pd.DataFrame):
+        df_event_repo_id = df_repo
+    else:
+        df_event_repo_id = pd.read_csv(df_repo.csv_path, usecols=['id', 'repo_id'])
+    df_event_repo_id = df_event_repo_id[['id', 'repo_id']].dropna()
+    return dict(zip(df_event_repo_id['id'].astype('int64'), df_event_repo_id['repo_id'].astype('int64')))
+
+
+# Extract the collaboration relations of the records with index in [rec_add_mode_skip_to_loc, limit) of a repo.
+# df_repo: the DataFrame of the repo event logs, or an iterable of its DataFrame chunks to process the repo in streaming
+#   mode, e.g. CsvChunkReader, the peak memory is then bounded by the chunk size.
+# checkpoint: commit the progress into the journal '<save_path>.checkpoint.json' with the output flushes, and resume from
+#   the journal of an unfinished run, the rows written after the last commit are truncated.
+# warm_link_cache: load the links resolved in the existing result file into the cache before the repo is processed, the
+#   new rows are appended to the file when add_mode_if_exists=True and no checkpoint journal is resumed.
+# cache_metrics_path: append the cache statistics into this file when the repo is completed, set None to save them into
+#   'cache_metrics.jsonl' in the directory of save_path.
+# defer_rate_limit: see records_collaboration_relation_extraction.
+# process_checkpoint: [repo_key, repo_loc, record_loc], the record_loc is updated in place to locate the stopped record.
+def repo_collaboration_relation_extraction(repo_key, df_repo, save_path, rec_add_mode_skip_to_loc=0, limit=-1,
+                                           add_mode_if_exists=True, cache=None, use_relation_type_list=None,
+                                           batch_ner=True, vectorized_event_action=True, link_workers=0,
+                                           checkpoint=False, warm_link_cache=False, cache_metrics_path=None,
+                                           defer_rate_limit=False, process_checkpoint=None):
+    I_REPO_LOC = 1
+    I_RECORD_LOC = 2
+    process_checkpoint = process_checkpoint if process_checkpoint is not None else [repo_key, 0, 0]
+    i = process_checkpoint[I_REPO_LOC]
+    journal = None
+    if checkpoint:
+        journal = CollaborationNetworkJournal(save_path)
+        resume_loc = journal.recover()
+        if resume_loc is not None:
+            logger.info(f"Processing progress: {repo_key}@{i}: resume from the record index {resume_loc} by the "
+                        f"checkpoint journal {journal.journal_path}.")
+            rec_add_mode_skip_to_loc = resume_loc
+            add_mode_if_exists = True
+        else:
+            journal.remove()  # the journal of a completed run
+    if warm_link_cache and cache is not None and os.path.exists(save_path):
+        d_event_repo_id = get_d_event_repo_id(df_repo)
+        rec_repo_id = pd.Series(list(d_event_repo_id.values())).mode().iloc[0] if len(d_event_repo_id) else None
+        n_links = warm_link_cache_from_csv(cache, save_path, d_event_repo_id=d_event_repo_id,
+                                           rec_repo_id=rec_repo_id)
+        logger.info(f"Processing progress: {repo_key}@{i}: {n_links} links are loaded into the link cache from {save_path}.")
+    df_repo_chunks = [df_repo] if isinstance(df_repo, pd.DataFrame) else df_repo
+    limit_reached = False
+    with CollaborationNetworkWriter(save_path, add_mode_if_exists=add_mode_if_exists, journal=journal,
+                                    checkpoint={"last_index": rec_add_mode_skip_to_loc - 1, "last_event_id": None}) as writer:
+        for df_repo_chunk in df_repo_chunks:
+            df_repo_todo = df_repo_chunk[df_repo_chunk.index >= rec_add_mode_skip_to_loc]
+            if limit > 0:
+                df_repo_todo = df_repo_todo[df_repo_todo.index < limit]
+            cache = records_collaboration_relation_extraction(
+                df_repo_todo, writer, cache=cache, use_relation_type_list=use_relation_type_list, batch_ner=batch_ner,
+                vectorized_event_action=vectorized_event_action, link_workers=link_workers,
+                defer_rate_limit=defer_rate_limit, process_checkpoint=process_checkpoint)
+            if limit > 0:
+                indexes_out_of_limit = df_repo_chunk.index[df_repo_chunk.index >= limit]
+                if len(indexes_out_of_limit):
+                    limit_reached = True
+                    process_checkpoint[I_RECORD_LOC] = indexes_out_of_limit[0]
+                    logger.info(
+                        f"Processing progress: {repo_key}@{i}: [{rec_add_mode_skip_to_loc}: {indexes_out_of_limit[0]}]. Batch task completed!")
+                    break
+    if journal is not None and not limit_reached:
+        journal.mark_completed()
+    logger.info(f"Processing progress: {repo_key}@{i}#{process_checkpoint[I_RECORD_LOC]}: task completed!")
+    d_cache_stats = get_cache_stats()
+    logger.info(f"Cache statistics: {repo_key}@{i}: {format_cache_stats(d_cache_stats)}")
+    cache_metrics_path = cache_metrics_path or os.path.join(os.path.dirname(save_path), 'cache_metrics.jsonl')
+    save_cache_stats(cache_metrics_path, d_cache_stats, repo_key=repo_key)
+    return cache
+
+
+# the number of records of a DataFrame, or the file size of a CsvChunkReader, to schedule the largest repos first
+def get_repo_size(df_repo):
+    if isinstance(df_repo, pd.DataFrame):
+        return len(df_repo)
+    return os.path.getsize(df_repo.csv_path) if os.path.exists(df_repo.csv_path) else 0
+
+
+def _init_extraction_worker(log_queue):
+    # send all the log records of the worker process to the parent process
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(QueueHandler(log_queue))
+    root_logger.setLevel(logging.INFO)
+
+
+def _repo_collaboration_relation_extraction_worker(repo_key, df_repo, save_path, repo_loc, cache_max_size=200,
+                                                   persistent_cache_path=None, **kwargs):
+    process_checkpoint = [repo_key, repo_loc, 0]
+    try:
+        persistent_store = enable_persistent_cache(persistent_cache_path) if persistent_cache_path else None
+        cache = get_link_cache(cache_max_size, persistent_store=persistent_store)
+        repo_collaboration_relation_extraction(repo_key, df_repo, save_path, cache=cache,
+                                               process_checkpoint=process_checkpoint, **kwargs)
+        completed = True
+    except BaseException as e:
+        logger.info(f"Processing progress: {process_checkpoint[0]}@{process_checkpoint[1]}#{process_checkpoint[2]}. "
+                    f"The process stopped due to an exception!")
+        tb_lines = traceback.format_exception(e.__class__, e, e.__traceback__)
+        logger.error(''.join(tb_lines))
+        completed = False
+    return process_checkpoint, completed
+
+
 def collaboration_relation_extraction(repo_keys, df_dbms_repos_dict, save_dir, repo_key_skip_to_loc=None,
                                       last_stop_index=None, limit=None, update_exists=True, add_mode_if_exists=True,
-                                      cache_max_size=200, use_relation_type_list=None):
+                                      cache_max_size=200, use_relation_type_list=None, batch_ner=True,
+                                      vectorized_event_action=True, link_workers=0, workers=1, checkpoint=False,
+                                      persistent_cache_path=None, warm_link_cache=False, defer_rate_limit=False):
     """
     :param repo_keys: filenames right stripped by suffix `.csv`
-    :param df_dbms_repos_dict: key: repo_keys, value: dataframe of dbms repos event logs
+    :param df_dbms_repos_dict: key: repo_keys, value: dataframe of dbms repos event logs, or CsvChunkReader to read and
+        process the event logs chunk by chunk in streaming mode, see get_csv_chunk_readers
     :param save_dir: save the results for each `repo_key` in repo_keys into this directory
     :param repo_key_skip_to_loc: skip the indexes of repo keys smaller than repo_key_skip_to_loc in the order of df_dbms_repos_dict.keys()
     :param last_stop_index: set last_stop_index = -1 or None(by default) if skip nothing
     :param limit: set limit = -1 or None(by default) if no limit
     :param update_exists: only process repo_keys not exists old result when update_exists=False
-    :param add_mode_if_exists: only takes effect when parameter update_exists=True
+    :param add_mode_if_exists: only takes effect when parameter update_exists=True. Append the new rows to the existing
+        result file of a repo, set add_mode_if_exists=False to overwrite it, e.g. a full rerun of the repos.
     :param cache_max_size: int type, set cache_max_size=-1 if you donot want to use any cache
     :param use_relation_type_list: to optionally extract the relation types in ['EventAction', 'Reference'], see event_trigger_ERE_triples_dict.
+    :param batch_ner: recognize the body links of all records to be processed in a repo at once instead of once per record
+    :param vectorized_event_action: build the EventAction relations of all records to be processed in a repo with column
+        operations, only the records with missing PKs fall back to the per-record extraction
+    :param link_workers: resolve the body links of the records to be processed in two phases: collect the distinct
+        links at first, then search their entities concurrently by link_workers threads before emitting the relations.
+        Set link_workers=0(by default) to search each link when its record is processed.
+    :param workers: the number of worker processes, each repo is processed by one worker and saved into its own file,
+        the largest repos are scheduled first. Set workers=1(by default) to process the repos sequentially.
+    :param checkpoint: keep a checkpoint journal '<repo_key>.csv.checkpoint.json' for each result file, a restart resumes
+        the unfinished repos from their journals without duplicated records, the completed repos are skipped when
+        update_exists=False. The journals take precedence over last_stop_index. Set checkpoint=False(by default) to
+        only resume by last_stop_index.
+    :param persistent_cache_path: the sqlite3 database file of the disk-backed cache tier shared across runs and worker
+        processes, for the DB queries, the GitHub API requests and the link cache. The worker processes claim the
+        entities being resolved in it, so that each entity is resolved only once by all the workers. Set None(by default)
+        to only cache in memory.
+    :param warm_link_cache: load the links resolved in the existing result file of each repo into the link cache before
+        the repo is processed again, e.g. a rerun after the relation schema changed. The cache_max_size should be large
+        enough to keep them. Set add_mode_if_exists=False for a full rerun, or the rows are appended to the existing
+        ones and duplicated.
+    :param defer_rate_limit: when the GitHub rate limits of all the tokens are exceeded, put off the records depending
+        on the API and keep extracting the other records instead of sleeping until the quota is reset, the deferred
+        records are retried after the reset and written in place. Set defer_rate_limit=False(by default) to sleep.
     :return: None
     """
     repo_key_skip_to_loc = repo_key_skip_to_loc if repo_key_skip_to_loc is not None else 0
@@ -102,43 +390,73 @@ def collaboration_relation_extraction(repo_keys, df_dbms_repos_dict, save_dir, r
     rec_add_mode_skip_to_loc = last_stop_index + 1
 
     limit = limit if limit is not None else -1
-    I_REPO_KEY = 0
-    I_REPO_LOC = 1
-    I_RECORD_LOC = 2
+    kwargs = dict(limit=limit, add_mode_if_exists=add_mode_if_exists, use_relation_type_list=use_relation_type_list,
+                  batch_ner=batch_ner, vectorized_event_action=vectorized_event_action, link_workers=link_workers,
+                  checkpoint=checkpoint, warm_link_cache=warm_link_cache, defer_rate_limit=defer_rate_limit)
+    # [(repo_loc, repo_key, save_path, rec_add_mode_skip_to_loc)], the last_stop_index only works on the first repo to process
+    repo_tasks = []
+    for i, repo_key in enumerate(repo_keys):
+        if i < repo_key_skip_to_loc:
+            continue
+        save_path = os.path.join(save_dir, f'{repo_key}.csv')
+        d_checkpoint = CollaborationNetworkJournal(save_path).load() if checkpoint else None
+        unfinished = d_checkpoint is not None and not d_checkpoint.get("completed")
+        if os.path.exists(save_path) and not update_exists and not unfinished:
+            continue
+        repo_tasks.append((i, repo_key, save_path, rec_add_mode_skip_to_loc))
+        rec_add_mode_skip_to_loc = 0
+
+    if workers > 1 and len(repo_tasks) > 1:
+        repo_tasks = sorted(repo_tasks, key=lambda task: get_repo_size(df_dbms_repos_dict[task[1]]), reverse=True)
+        log_queue = multiprocessing.Queue(-1)
+        log_listener = QueueListener(log_queue, *logging.getLogger().handlers, respect_handler_level=True)
+        log_listener.start()
+        try:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_extraction_worker,
+                                     initargs=(log_queue,)) as executor:
+                # future: the process_checkpoint of its repo before it is started
+                futures = {executor.submit(_repo_collaboration_relation_extraction_worker, repo_key,
+                                           df_dbms_repos_dict[repo_key], save_path, i, cache_max_size=cache_max_size,
+                                           persistent_cache_path=persistent_cache_path,
+                                           rec_add_mode_skip_to_loc=skip_to_loc, **kwargs): [repo_key, i, skip_to_loc]
+                           for i, repo_key, save_path, skip_to_loc in repo_tasks}
+                stopped_checkpoints = []
+                for n_done, future in enumerate(as_completed(futures), start=1):
+                    try:
+                        process_checkpoint, completed = future.result()
+                    except Exception as e:  # e.g. BrokenProcessPool after a worker process crashed
+                        process_checkpoint, completed = futures[future], False
+                        logger.info(f"Processing progress: {process_checkpoint[0]}@{process_checkpoint[1]}. "
+                                    f"The worker process stopped due to an exception!")
+                        tb_lines = traceback.format_exception(e.__class__, e, e.__traceback__)
+                        logger.error(''.join(tb_lines))
+                    if not completed:
+                        stopped_checkpoints.append(process_checkpoint)
+                    logger.info(f"Processing progress: {n_done}/{len(futures)} repos done, "
+                                f"{process_checkpoint[0]}@{process_checkpoint[1]}#{process_checkpoint[2]} "
+                                f"{'completed' if completed else 'stopped'}.")
+            if stopped_checkpoints:
+                logger.info(f"Processing progress: {len(stopped_checkpoints)} repos stopped due to exceptions: "
+                            f"{[f'{c[0]}@{c[1]}#{c[2]}' for c in stopped_checkpoints]}")
+            else:
+                logger.info(f"Processing progress: all task completed!")
+        finally:
+            log_listener.stop()
+        return
+
     process_checkpoint = ['', 0, 0]
-    cache = QueryCache(max_size=cache_max_size) if cache_max_size > 0 else None
-    cache.match_func = partial(QueryCache.d_match_func,
-                               **{"feat_keys": ["link_pattern_type", "link_text", "rec_repo_id"]})
+    persistent_store = enable_persistent_cache(persistent_cache_path) if persistent_cache_path else None
+    cache = get_link_cache(cache_max_size, persistent_store=persistent_store)
     try:
-        for i, repo_key in enumerate(repo_keys):
-            process_checkpoint[I_REPO_KEY] = repo_key
-            process_checkpoint[I_REPO_LOC] = i
-            if i < repo_key_skip_to_loc:
-                continue
-            df_repo = df_dbms_repos_dict[repo_key]
-            save_path = os.path.join(save_dir, f'{repo_key}.csv')
-            if os.path.exists(save_path) and not update_exists:
-                continue
-
-            for index, rec in df_repo.iterrows():
-                process_checkpoint[I_RECORD_LOC] = index
-                if limit > 0:
-                    if index >= limit:
-                        logger.info(
-                            f"Processing progress: {repo_key}@{i}: [{rec_add_mode_skip_to_loc}: {index}]. Batch task completed!")
-                        break
-                if index < rec_add_mode_skip_to_loc:
-                    continue
-                obj_collaboration_tuple_list, cache = get_obj_collaboration_tuples_from_record(
-                    rec, cache=cache, use_relation_type_list=use_relation_type_list)
-                df_collaboration = get_df_collaboration(obj_collaboration_tuple_list, extend_field=True)
-                save_GitHub_Collaboration_Network(df_collaboration, save_path=save_path, add_mode_if_exists=add_mode_if_exists)
-            logger.info(f"Processing progress: {repo_key}@{i}#{process_checkpoint[I_RECORD_LOC]}: task completed!")
-            rec_add_mode_skip_to_loc = 0
+        for i, repo_key, save_path, skip_to_loc in repo_tasks:
+            process_checkpoint[:] = [repo_key, i, 0]
+            cache = repo_collaboration_relation_extraction(repo_key, df_dbms_repos_dict[repo_key], save_path,
+                                                           rec_add_mode_skip_to_loc=skip_to_loc, cache=cache,
+                                                           process_checkpoint=process_checkpoint, **kwargs)
         logger.info(f"Processing progress: all task completed!")
     except BaseException as e:
         logger.info(
-            f"Processing progress: {process_checkpoint[I_REPO_KEY]}@{process_checkpoint[I_REPO_LOC]}#{process_checkpoint[I_RECORD_LOC]}. "
+            f"Processing progress: {process_checkpoint[0]}@{process_checkpoint[1]}#{process_checkpoint[2]}. "
             f"The process stopped due to an exception!")
         tb_lines = traceback.format_exception(e.__class__, e, e.__traceback__)
         logger.error(''.join(tb_lines))
@@ -175,17 +493,23 @@ if __name__ == '__main__':
     else:
         filenames = filenames_exists
 
-    # Preprocess body content
-    dbms_repos_dedup_content_dir = os.path.join(filePathConf.absPathDict[filePathConf.GITHUB_OSDB_DATA_DIR], 'repos_dedup_content')
-    process_body_content(raw_content_dir=dbms_repos_raw_content_dir, processed_content_dir=dbms_repos_dedup_content_dir, filenames=filenames)
-    df_dbms_repos_dict = read_csvs(dbms_repos_dedup_content_dir, filenames=filenames, index_col=0)
+    STREAMING = False  # read, deduplicate and extract the raw repo files chunk by chunk for the repos with millions of events
+    if STREAMING:
+        df_dbms_repos_dict = get_csv_chunk_readers(dbms_repos_raw_content_dir, filenames=filenames, chunksize=10000,
+                                                   dedup=True, index_col=0)
+    else:
+        # Preprocess body content
+        dbms_repos_dedup_content_dir = os.path.join(filePathConf.absPathDict[filePathConf.GITHUB_OSDB_DATA_DIR], 'repos_dedup_content')
+        process_body_content(raw_content_dir=dbms_repos_raw_content_dir, processed_content_dir=dbms_repos_dedup_content_dir, filenames=filenames)
+        df_dbms_repos_dict = read_csvs(dbms_repos_dedup_content_dir, filenames=filenames, index_col=0)
     repo_keys = list(df_dbms_repos_dict.keys())
 
     # Collaboration Relation extraction
     relation_extraction_save_dir = os.path.join(filePathConf.absPathDict[filePathConf.GITHUB_OSDB_DATA_DIR],
                                                 "GitHub_Collaboration_Network_repos")
     collaboration_relation_extraction(repo_keys, df_dbms_repos_dict, relation_extraction_save_dir, update_exists=False,
-                                      add_mode_if_exists=True, use_relation_type_list=["EventAction", "Reference"], last_stop_index=-1)
+                                      add_mode_if_exists=True, use_relation_type_list=["EventAction", "Reference"], last_stop_index=-1,
+                                      link_workers=8, checkpoint=True, defer_rate_limit=True)
 
     # # Just for test
     # import pandas as pd
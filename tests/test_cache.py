@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Python 3.9
+
+# @Time   : 2026/10/18 15:00
+# @Author : 'Lou Zehua'
+# @File   : test_cache.py
+
+from functools import partial
+
+from GH_CoRE.utils.cache import QueryCache
+
+
+def get_cache(**kwargs):
+    cache = QueryCache(**kwargs)
+    cache.match_func = partial(QueryCache.d_match_func, **{"feat_keys": ["k"]})
+    return cache
+
+
+def test_later_duplicate_found_after_the_earlier_one_evicted():
+    cache = get_cache(max_size=2, policy='fifo')
+    cache.add_record({"k": 1, "v": "old"}, skip_dup=False)
+    cache.add_record({"k": 1, "v": "new"}, skip_dup=False)
+    cache.add_record({"k": 2, "v": "x"})
+    assert dict(cache.find_record_in_cache({"k": 1}))["v"] == "new"
+    assert dict(cache.find_record_in_cache({"k": 2}))["v"] == "x"
+
+
+def test_earlier_duplicate_kept_until_removed():
+    cache = get_cache(max_size=10)
+    cache.find_record_in_cache({"k": 1})  # build the index before the records are added
+    for v in ["a", "b", "c"]:
+        cache.add_record({"k": 1, "v": v}, skip_dup=False)
+    assert dict(cache.find_record_in_cache({"k": 1}))["v"] == "a"
+    cache.max_size = 1
+    cache.add_record({"k": 2, "v": "x"})
+    assert cache.find_record_in_cache({"k": 1}) is None
+    assert dict(cache.find_record_in_cache({"k": 2}))["v"] == "x"
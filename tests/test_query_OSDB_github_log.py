@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Python 3.9
+
+# @Time   : 2026/10/18 10:00
+# @Author : 'Lou Zehua'
+# @File   : test_query_OSDB_github_log.py
+
+import datetime
+
+import pytest
+
+from GH_CoRE.utils.conndb import ClickHouseClientPool, ConnDB
+from GH_CoRE.working_flow import query_OSDB_github_log as query_log
+
+COLUMNS_WITH_TYPES = [('id', 'UInt64'), ('issue_number', 'Nullable(Int64)'), ('repo_name', 'LowCardinality(String)'),
+                      ('created_at', 'DateTime'), ('body', 'String'), ('issue_assignees.login', 'Array(String)')]
+# the first block has no NULLs, the second one has
+ROWS = [
+    (1, 1, 'a/b', datetime.datetime(2023, 1, 1), 'x', []),
+    (2, 2, 'c/d', datetime.datetime(2023, 1, 2), 'y, "z"\n', ['u']),
+    (3, None, 'a/b', datetime.datetime(2023, 1, 3, 8), '', ['u', 'v']),
+    (4, 4, 'a/b', datetime.datetime(2023, 1, 4), None, []),
+]
+
+
+class FakeClient:
+    connection = type('FakeConnection', (), {'connected': True, 'ping': lambda self: True})()
+
+    @staticmethod
+    def _query(sql):
+        d_types = dict(COLUMNS_WITH_TYPES)
+        columns = sql.split('SELECT ')[1].split(' FROM ')[0].split(', ')
+        columns_with_types = [(name, d_types[name]) for name in columns]
+        i_columns = [COLUMNS_WITH_TYPES.index(c) for c in columns_with_types]
+        rows = [tuple(row[i] for i in i_columns) for row in ROWS if f"'{row[2]}'" in sql.split('repo_name')[-1]]
+        return columns_with_types, rows
+
+    def execute(self, sql, columnar=False, with_column_types=False):
+        columns_with_types, rows = self._query(sql)
+        return list(zip(*rows)), columns_with_types
+
+    def execute_iter(self, sql, with_column_types=False, settings=None):
+        columns_with_types, rows = self._query(sql)
+        yield columns_with_types
+        yield from rows
+
+    def disconnect(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def fake_client(monkeypatch):
+    monkeypatch.setattr(ClickHouseClientPool, '_new_client', lambda self: FakeClient())
+
+
+def test_stream_blocks_with_nulls_same_as_dataframe(tmp_path):
+    columns = [name for name, _ in COLUMNS_WITH_TYPES]
+    sql = query_log.get_repo_year_sql('a/b', 2023, columns)
+    query_log.download_repo_year('a/b', 2023, columns, str(tmp_path / 'df.csv'))
+    query_log.stream_query_to_csv(sql, str(tmp_path / 'stream.csv'), max_block_size=2, show_progress=False)
+    content = (tmp_path / 'df.csv').read_bytes()
+    assert content == (tmp_path / 'stream.csv').read_bytes()
+    assert b'\n0,1,1,a/b,' in content and b'\n1,3,,a/b,' in content and b'\n2,4,4,a/b,' in content
+
+
+def test_multi_repo_download_same_as_single_repo(tmp_path):
+    columns = ['id', 'issue_number', 'body']
+    (tmp_path / 'single').mkdir()
+    (tmp_path / 'batch').mkdir()
+    for repo_name in ['a/b', 'c/d', 'e/f']:
+        query_log.download_repo_year(repo_name, 2023, columns, str(tmp_path / 'single' / f"{repo_name[0]}.csv"))
+    query_log.download_repos_year(['a/b', 'c/d', 'e/f'], 2023, columns, str(tmp_path / 'batch'), max_block_size=1)
+    for repo_name in ['a/b', 'c/d', 'e/f']:
+        filename = query_log.get_repo_year_filename(query_log.get_repo_name_fileformat(repo_name), 2023)
+        assert (tmp_path / 'batch' / filename).read_bytes() == \
+               (tmp_path / 'single' / f"{repo_name[0]}.csv").read_bytes()
+
+
+@pytest.mark.parametrize("error, n_calls", [(ConnectionResetError, 3), (PermissionError, 1)])
+def test_only_connection_errors_rerun(error, n_calls):
+    calls = []
+
+    def func(client):
+        calls.append(client)
+        raise error()
+
+    with pytest.raises(error):
+        ConnDB(exit_on_error=False).run_with_client(func, retry=2)
+    assert len(calls) == n_calls
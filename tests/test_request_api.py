@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Python 3.9
+
+# @Time   : 2026/10/18 14:00
+# @Author : 'Lou Zehua'
+# @File   : test_request_api.py
+
+import time
+
+import pytest
+
+from GH_CoRE.utils.cache import PersistentCacheStore, QueryCache
+from GH_CoRE.utils.request_api import CachedResponse, GitHubTokenPool, RequestAPI, RequestGitHubAPI
+
+
+def test_search_rate_limit_shared_with_unprobed_buckets():
+    token_pool = GitHubTokenPool(github_tokens=['token_a', 'token_b', 'token_c'])
+    bucket = token_pool.get_token_bucket('search')
+    bucket['token_c']['reset'] = int(time.time()) + 10  # probed, with an earlier reset
+    reset = int(time.time()) + 60
+    token = token_pool.get_GithubToken('search')
+    response = CachedResponse(403, headers={'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(reset),
+                                            'X-Ratelimit-Resource': 'search'})
+    token_pool.update_GithubTokenState_list(token, response, 'search')
+    for tokenState in bucket.values():
+        assert tokenState['remaining'] == 0
+        assert tokenState['reset'] == reset
+        assert tokenState['inflight'] == 0
+
+
+def test_inflight_released_when_request_raises(monkeypatch):
+    token_pool = GitHubTokenPool(github_tokens=['token_a'])
+
+    def raise_error(*args, **kwargs):
+        raise RuntimeError("unexpected")
+
+    monkeypatch.setattr(RequestGitHubAPI, 'request_conditional', raise_error)
+    with pytest.raises(RuntimeError):
+        RequestGitHubAPI(token_pool=token_pool).request('https://api.github.com/repos/a/inflight-test')
+    assert token_pool.get_token_bucket('core')['token_a']['inflight'] == 0
+
+
+def test_expired_persistent_response_revalidated_by_etag(tmp_path, monkeypatch):
+    store = PersistentCacheStore(str(tmp_path / "cache.sqlite3"))
+    cache = QueryCache(max_size=10)
+    cache.set_persistent_store(store, 'github_rest_api', ttl=60)
+    monkeypatch.setattr(RequestGitHubAPI, 'cache', cache)
+    monkeypatch.setattr(RequestGitHubAPI, 'etag_store', store)
+    url = 'https://api.github.com/repos/a/etag-test'
+    sent_headers = []
+
+    def fake_request(self, url, *args, **kwargs):
+        sent_headers.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == '"v1"':
+            return CachedResponse(304, url=url)
+        return CachedResponse(200, url=url, json_data={"id": 1}, headers={'ETag': '"v1"'})
+
+    monkeypatch.setattr(RequestAPI, 'request', fake_request)
+    token_pool = GitHubTokenPool(github_tokens=['token_a'])
+    assert RequestGitHubAPI(token_pool=token_pool).request(url).json() == {"id": 1}
+    cache.clear()  # a rerun only finds the response in the persistent store
+    assert RequestGitHubAPI(token_pool=token_pool).request(url).json() == {"id": 1}
+    assert len(sent_headers) == 1
+    cache.clear()
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 120)  # the persisted response expires
+    response = RequestGitHubAPI(token_pool=token_pool).request(url)
+    assert response.status_code == 200 and response.json() == {"id": 1}
+    assert len(sent_headers) == 2 and sent_headers[1].get('If-None-Match') == '"v1"'